@@ -1,20 +1,27 @@
 import sublime
 import sublime_plugin
 import os
-import io
 import errno
 import timeit
 import time
 import ctypes
 import time
 import shutil
+import struct
 import threading
+import collections
+import traceback
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import WhooshSearch.whoosh.analysis
 
 from WhooshSearch.whoosh import index
+from WhooshSearch.whoosh import writing
 from WhooshSearch.whoosh.fields import *
+from WhooshSearch.whoosh.columns import NumericColumn, CompressedBlockColumn
 from WhooshSearch.whoosh.filedb.filestore import FileStorage
+from WhooshSearch.whoosh.filedb.filetables import HashWriter, HashReader
 from WhooshSearch.whoosh.qparser import QueryParser
 from WhooshSearch.whoosh.analysis \
     import RegexTokenizer, IntraWordFilter, LowercaseFilter, StopFilter, MultiFilter, FancyAnalyzer
@@ -22,7 +29,15 @@ from WhooshSearch.whoosh.compat import u
 from WhooshSearch.whoosh import highlight
 from WhooshSearch.whoosh.analysis import Token
 from WhooshSearch.whoosh.query import Phrase
-from itertools import groupby
+from WhooshSearch.whoosh.multiproc import MpWriter
+from WhooshSearch.whoosh.codec.whoosh3 import W3BinaryCodec
+from WhooshSearch.whoosh.codec.memory import MemoryCodec
+from WhooshSearch.whoosh.reading import MultiReader
+from WhooshSearch.whoosh.searching import Searcher
+from WhooshSearch.whoosh_loader import is_binary_file, file_content, file_document
+from itertools import groupby, accumulate, count
+from bisect import bisect_right
+import operator
 import multiprocessing
 
 
@@ -40,6 +55,29 @@ sys.argv = [""]
 
 current_milli_time = lambda: int(round(time.time() * 1000))
 
+# Period of status bar updates while index jobs are running
+_status_interval = 1000
+
+# Number of best files painted before the rest of the results and size of
+# text chunks appended to the results view
+_first_page_files = 50
+_render_chunk_size = 64 * 1024
+
+# Saving files commits a segment without merging. A background merger of the
+# index folder merges segments of the same size tier once there are
+# _merge_segments_per_tier of them
+_merge_segments_per_tier = 10
+_merge_max_docs = 500000
+
+# Index writers wait for a background merge to swap its segment in
+_writer_lock_timeout = 5.0
+
+# In near real time mode saved files are searchable from a memory segment
+# at once. It is committed to the index folder when it has _recent_max_files
+# files or its first file was saved _recent_max_seconds ago
+_recent_max_files = 100
+_recent_max_seconds = 60
+
 # Whoosh settings
 _whoosh_search_settings = "WhooshSearch.sublime-settings"
 _settings = None
@@ -80,6 +118,446 @@ class WhooshSearchHistory():
 
 _search_history = WhooshSearchHistory(100)
 
+# Number of threads checking files for binary content while indexing, number
+# of files checked by one pool task and maximum number of waiting tasks
+_sniff_threads = 4
+_sniff_chunk = 32
+_sniff_queue = 8
+
+
+# WhooshStats accumulates time and number of files passed through indexing
+# stages (walk, filter, analyze). Stages may be updated from several threads
+class WhooshStats():
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, count=1):
+        with self.lock:
+            total, files = self.stages.get(stage, (0.0, 0))
+            self.stages[stage] = (total + seconds, files + count)
+
+    def report(self):
+        with self.lock:
+            return ", ".join("%s %d files [%.0f files/s]" %
+                             (stage, files, files / total if total else 0)
+                             for stage, (total, files) in self.stages.items())
+
+
+class WhooshCancelled(Exception):
+    pass
+
+
+# WhooshProgress is the state of an index job shown in the status bar:
+# message, files done/total, read bytes and cancellation request
+class WhooshProgress():
+    def __init__(self):
+        self.cancelled = False
+        self.begin("")
+
+    def begin(self, message, total=0):
+        self.message = message
+        self.total = total
+        self.done = 0
+        self.bytes = 0
+        self.started = timeit.default_timer()
+
+    def check(self):
+        if self.cancelled:
+            raise WhooshCancelled()
+
+    def advance(self, size=0):
+        self.check()
+        self.done += 1
+        self.bytes += size
+
+    def text(self):
+        if not self.message or not self.done:
+            return self.message
+
+        elapsed = max(timeit.default_timer() - self.started, 0.001)
+        left = self.total - self.done
+
+        text = "%s: %d" % (self.message, self.done)
+        if left > 0:
+            text += "/%d" % self.total
+        text += " [%.1f MB/s" % (self.bytes / elapsed / (1024 * 1024))
+        if left > 0:
+            text += ", ETA %d s" % (elapsed * left / self.done)
+        return text + "]"
+
+
+# WhooshWorker runs index jobs (WhooshIndex, WhooshReset, WhooshSave) of one
+# project one after another on a single thread, so jobs never race for the
+# index lock. Jobs are queued by key and a job is dropped if the same key or
+# a covering key is already queued
+class WhooshWorker():
+    def __init__(self):
+        self.jobs = collections.OrderedDict()
+        self.current = None
+        self.condition = threading.Condition()
+        self.saved = set()
+        self.save_generation = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, key, job, covered_by=(), cancel=()):
+        with self.condition:
+            for cancel_key in cancel:
+                self.jobs.pop(cancel_key, None)
+                if self.current and self.current[0] == cancel_key:
+                    self.current[1].progress.cancelled = True
+
+            if any(k in self.jobs for k in covered_by):
+                return False
+
+            if key in self.jobs:
+                self.jobs[key].merge(job)
+                return False
+
+            self.jobs[key] = job
+            self.condition.notify()
+            return True
+
+    # Saved files are collected until no file is saved for save_delay_ms and
+    # then reindexed by one WhooshSave job
+    def save_later(self, window, file_name):
+        with self.condition:
+            self.saved.add(file_name)
+            self.save_generation += 1
+            generation = self.save_generation
+
+        sublime.set_timeout_async(lambda: self.flush_saves(window, generation),
+                                  _settings.get("save_delay_ms", 500))
+
+    def flush_saves(self, window, generation):
+        with self.condition:
+            if generation != self.save_generation:
+                # more files were saved since, their timer will flush
+                return
+            file_names, self.saved = self.saved, set()
+
+        whoosh_save = WhooshSave(window, file_names)
+        whoosh_save.submit(("save",), covered_by=(("index",), ("reset",)))
+
+    # commits the memory segment created at created time, unless it is
+    # committed by then
+    def flush_recent_later(self, window, created):
+        whoosh_flush = WhooshFlush(window, created)
+        sublime.set_timeout_async(
+            lambda: whoosh_flush.submit(("flush",), covered_by=(("index",), ("reset",))),
+            int(_recent_max_seconds * 1000))
+
+    def cancel(self):
+        with self.condition:
+            cancelled = bool(self.jobs)
+            self.jobs.clear()
+            if self.current:
+                self.current[1].progress.cancelled = True
+                cancelled = True
+            return cancelled
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                self.current = self.jobs.popitem(last=False)
+                job = self.current[1]
+
+            self.show_progress(job)
+            try:
+                job()
+            except WhooshCancelled:
+                job.window.status_message("WhooshSearch: Indexing is cancelled")
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.condition:
+                    self.current = None
+
+    # the only timer refreshing status bar while a job is running
+    def show_progress(self, job):
+        with self.condition:
+            if not self.current or self.current[1] is not job:
+                return
+
+        text = job.progress.text()
+        if text:
+            job.window.status_message(text)
+        sublime.set_timeout_async(lambda: self.show_progress(job), _status_interval)
+
+
+_workers = {}
+_workers_lock = threading.Lock()
+
+
+def project_worker(project_name):
+    with _workers_lock:
+        worker = _workers.get(project_name)
+        if worker is None:
+            worker = _workers[project_name] = WhooshWorker()
+        return worker
+
+
+# WhooshRecent is a memory segment of files saved since the last commit of
+# the index folder. Older versions of the files stay in the index folder and
+# are masked out of searches. It is guarded by its searcher pool entry lock
+class WhooshRecent():
+    def __init__(self, schema):
+        self.schema = schema
+        self.codec = MemoryCodec()
+        self.created = time.time()
+        # path -> manifest signature (None for deleted files) and docnum in
+        # the memory segment
+        self.files = {}
+        self.docnums = {}
+        self.disk_searcher = None
+        self.searcher = None
+        self.mask = set()
+        # files added since the mask was built
+        self.unmasked = set()
+
+    # documents replace the documents of the same files saved before, files
+    # without a document (signature None) were deleted
+    def add(self, signatures, documents):
+        segment = self.codec.segment
+        writer = self.codec.writer(self.schema)
+        for path in signatures:
+            if path in self.docnums:
+                segment.delete_document(self.docnums.pop(path))
+            if path in documents:
+                self.docnums[path] = writer.docnum
+                writer.add_document(**documents[path])
+        writer.commit()
+        self.files.update(signatures)
+        self.unmasked.update(signatures)
+        self.searcher = None
+
+    # Returns the searcher of disk segments and the memory segment and the set
+    # of docnums of disk documents to mask. Disk segments come first, so their
+    # docnums are the same in both searchers
+    def search(self, disk_searcher):
+        if self.disk_searcher is not disk_searcher:
+            # docnums of the refreshed index folder are different
+            self.mask = set()
+            self.unmasked = set(self.files)
+            self.searcher = None
+
+        if self.searcher is None:
+            readers = [r for r, _ in disk_searcher.reader().leaf_readers()]
+            readers.append(self.codec.reader(self.schema))
+            self.searcher = Searcher(MultiReader(readers), closereader=False)
+            for path in self.unmasked:
+                self.mask.update(disk_searcher.document_numbers(path=path))
+            self.unmasked = set()
+            self.disk_searcher = disk_searcher
+        return self.searcher, self.mask
+
+
+# WhooshSearcherPool keeps an open searcher and a query parser per index
+# folder. Searches of a project are serialized on its entry and a changed
+# index is picked up with Searcher.refresh(), which reopens only the
+# segments changed since the previous search
+class WhooshSearcherPool():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def entry(self, index_path):
+        with self.lock:
+            entry = self.entries.get(index_path)
+            if entry is None:
+                entry = self.entries[index_path] = {"lock" : threading.Lock(),
+                                                    "searcher" : None,
+                                                    "parser" : None,
+                                                    "recent" : None}
+            return entry
+
+    # yields (searcher, parser, mask) which must not be used after the block,
+    # mask is None or a set of docnums to exclude from searches
+    @contextmanager
+    def searcher(self, index_path):
+        entry = self.entry(index_path)
+        with entry["lock"]:
+            searcher = entry["searcher"]
+            if searcher is None:
+                ix = index.open_dir(index_path)
+                searcher = ix.searcher()
+                entry["parser"] = QueryParser("content", schema=ix.schema)
+            elif not searcher.up_to_date():
+                searcher = searcher.refresh()
+            entry["searcher"] = searcher
+
+            if entry["recent"] is None:
+                yield searcher, entry["parser"], None
+            else:
+                recent_searcher, mask = entry["recent"].search(searcher)
+                yield recent_searcher, entry["parser"], mask
+
+    # returns creation time of the memory segment if it is created by this
+    # call or None
+    def add_recent(self, index_path, schema, signatures, documents):
+        entry = self.entry(index_path)
+        with entry["lock"]:
+            recent = entry["recent"]
+            if recent is None:
+                recent = entry["recent"] = WhooshRecent(schema)
+                created = recent.created
+            else:
+                created = None
+            recent.add(signatures, documents)
+            return created
+
+    # returns {path: signature} of files in the memory segment, if created is
+    # given only of the segment created at that time or before
+    def recent_files(self, index_path, created=None):
+        entry = self.entry(index_path)
+        with entry["lock"]:
+            recent = entry["recent"]
+            if recent is None or (created is not None and recent.created > created):
+                return {}
+            return dict(recent.files)
+
+    # must be called once files of the memory segment are committed
+    def drop_recent(self, index_path):
+        entry = self.entry(index_path)
+        with entry["lock"]:
+            entry["recent"] = None
+
+    # must be called before the index is recreated, its schema may change
+    def close(self, index_path):
+        entry = self.entry(index_path)
+        with entry["lock"]:
+            if entry["searcher"] is not None:
+                entry["searcher"].close()
+            entry["searcher"] = entry["parser"] = entry["recent"] = None
+
+
+_searcher_pool = WhooshSearcherPool()
+
+
+_mergers = {}
+_mergers_lock = threading.Lock()
+
+
+def index_merger(index_path):
+    with _mergers_lock:
+        merger = _mergers.get(index_path)
+        if merger is None:
+            policy = writing.TieredMergePolicy(_merge_segments_per_tier,
+                                               _merge_max_docs)
+            merger = _mergers[index_path] = \
+                writing.BackgroundMerger(index.open_dir(index_path), policy,
+                                         codec=W3BinaryCodec())
+        return merger
+
+
+# abandons the running merge, e.g. before the index is recreated
+def stop_merger(index_path):
+    with _mergers_lock:
+        merger = _mergers.pop(index_path, None)
+    if merger is not None:
+        merger.stop()
+
+
+# WhooshManifest is a sidecar file in the index folder which maps every indexed
+# file path to its (mtime, size, inode) signature. It allows to find changed
+# files without loading stored fields of the documents.
+class WhooshManifest():
+    name = "whoosh_manifest.hsh"
+    entry = struct.Struct("!dqq")
+
+    def __init__(self, index_path):
+        self.storage = FileStorage(index_path)
+        self.files = {}
+        self.loaded = False
+
+    @staticmethod
+    def signature(path):
+        st = os.stat(path)
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    # DirEntry.stat() has no inode on Windows, inode() has it
+    @staticmethod
+    def entry_signature(entry):
+        st = entry.stat()
+        return (st.st_mtime, st.st_size, entry.inode())
+
+    def exists(self):
+        return self.storage.file_exists(self.name)
+
+    def load(self):
+        self.files = {}
+        self.loaded = self.exists()
+        if not self.loaded:
+            return False
+
+        unpack = self.entry.unpack
+        reader = HashReader.open(self.storage, self.name)
+        try:
+            for key, value in reader.items():
+                self.files[key.decode("utf-8", "surrogateescape")] = unpack(value)
+        finally:
+            reader.close()
+        return True
+
+    # Reads signatures of the given paths only, e.g. of saved files. The
+    # manifest is not loaded after it and must not be saved
+    def load_paths(self, paths):
+        self.files = {}
+        self.loaded = False
+        if not self.exists():
+            return
+
+        unpack = self.entry.unpack
+        reader = HashReader.open(self.storage, self.name)
+        try:
+            for path in paths:
+                value = reader.get(path.encode("utf-8", "surrogateescape"))
+                if value is not None:
+                    self.files[path] = unpack(value)
+        finally:
+            reader.close()
+
+    # signatures read from the index columns have no inode
+    def add_indexed(self, path, mtime, size):
+        self.files[path] = (mtime, size, -1)
+
+    def changed(self, path, signature):
+        indexed = self.files.get(path)
+        if indexed is None:
+            return True
+        if indexed[2] < 0:
+            return indexed[:2] != signature[:2]
+        return indexed != signature
+
+    def save(self):
+        tmp_name = self.name + ".tmp"
+        pack = self.entry.pack
+        writer = HashWriter(self.storage.create_file(tmp_name))
+        for path, signature in self.files.items():
+            writer.add(path.encode("utf-8", "surrogateescape"), pack(*signature))
+        writer.close()
+        self.storage.rename_file(tmp_name, self.name)
+        self.loaded = True
+
+    def delete(self):
+        if self.exists():
+            self.storage.delete_file(self.name)
+        self.files = {}
+        self.loaded = False
+
+# Offsets of the first characters of all text lines. Everything runs in C,
+# so line lookups by bisect cost only the number of matches in python
+def line_starts(text):
+    starts = [0]
+    starts.extend(map(operator.add, accumulate(map(len, text.split('\n'))), count(1)))
+    # drop the start of the line after the end of text
+    starts.pop()
+    return starts
+
 
 def CustomFancyAnalyzer(expression=r"\s+", stoplist=STOP_WORDS, minsize=2,
                   maxsize=None, gaps=True, splitwords=False, splitnums=False,
@@ -161,28 +639,24 @@ class CustomPinpointFragmenter(highlight.PinpointFragmenter):
     """
 
     #extract line containing all words from searching phrase
+    #fragments get 1-based number of the line in "line" attribute
     def fragment_matches(self, text, tokens, words):
+        starts = line_starts(text)
         j = -1
 
         for i, t in enumerate(tokens):
             if j >= i:
                 continue
             j = i
-            left = t.startchar
-            right = t.endchar
-
-            while text[left] != '\n':
-                left -= 1
-                if left == 0:
-                    break
 
-            if left != 0:
-                left += 1
-
-            while text[right] != '\n' and text[right] != '\r':
-                right += 1
-                if right == len(text):
-                    break
+            line = bisect_right(starts, t.startchar)
+            left = starts[line - 1]
+            if line < len(starts):
+                right = starts[line] - 1
+                if right > left and text[right - 1] == '\r':
+                    right -= 1
+            else:
+                right = len(text)
 
             while j < len(tokens) - 1:
                 next = tokens[j + 1]
@@ -201,6 +675,7 @@ class CustomPinpointFragmenter(highlight.PinpointFragmenter):
                 continue
 
             fragment = highlight.Fragment(text, tokens[i:j + 1], left, right)
+            fragment.line = line
             yield fragment
 
 
@@ -221,7 +696,9 @@ class CustomFormatter(highlight.Formatter):
 class WhooshInfrastructure():
     def __init__(self, window):
         self.window = window
-        self.status_message_id = 0
+        self.progress = WhooshProgress()
+        self.stats = WhooshStats()
+        self._path_filters = None
 
     def __call__(self):
         raise NotImplementedError
@@ -244,39 +721,138 @@ class WhooshInfrastructure():
         return True
 
 
-    def status_message(self, message, timeout=1500):
-        if not message:
-            self.status_message_id = 0
+    # message is repeated in status bar by the project worker until next one
+    def status_message(self, message, total=0):
+        self.progress.begin(message, total)
+        if message:
+            self.window.status_message(message)
+
+
+    # queued job absorbs the same job submitted again
+    def merge(self, job):
+        pass
+
+
+    # run the job on the project worker
+    def submit(self, key, covered_by=(), cancel=()):
+        if not self.is_project():
+            self.window.status_message("WhooshSearch indexes only projects")
+            return False
+
+        return project_worker(self.project_name()).submit(key, self, covered_by, cancel)
+
+
+    #get (path, manifest signature) of all files in project that we are going to index
+    def project_files(self, check_binary=True):
+        files = (f for folder in self.project_folders()
+                   for f in self.walk_folder(folder))
+        if check_binary:
+            files = self.text_files(files)
+        return files
+
+
+    def walk_folder(self, folder):
+        if not hasattr(os, "scandir"):
+            yield from self.walk_folder_compat(folder)
             return
 
-        self.status_message_id = current_milli_time()
-        threading.Thread(target=self.periodic_status_message,
-                         args=(message, self.status_message_id, timeout)).start()
+        skip_folders, skip_files, skip_exts = self.path_filters()
+        project_exts = self.project_exts()
+        check_attributes = os.name == "nt"
 
+        start = timeit.default_timer()
+        folders = [folder]
+        while folders:
+            try:
+                entries = list(os.scandir(folders.pop()))
+            except OSError:
+                continue
 
-    def periodic_status_message(self, message, message_id, timeout=1000):
-        while True:
-            if message_id != self.status_message_id:
-                return
+            for entry in entries:
+                name = entry.name
+                if name.startswith('.'):
+                    continue
 
-            if not self.window:
-                return
+                try:
+                    if check_attributes and \
+                       entry.stat(follow_symlinks=False).st_file_attributes & 2:
+                        continue
 
-            self.window.status_message(message)
-            time.sleep(timeout / 1000)
+                    if entry.is_dir():
+                        # like os.walk, do not follow symlinks to folders
+                        if not entry.is_symlink() and name not in skip_folders:
+                            folders.append(entry.path)
+                        continue
 
+                    ext = os.path.splitext(name)[1]
+                    if not entry.is_file() or name in skip_files or \
+                       ext[1:] in skip_exts:
+                        continue
 
-    #get list of all files in project that we are going to index
-    #TODO return dictionary for quick search
-    def project_files(self):
-        for folder in self.project_folders():
-            folder_files = []
-            for (dirpath, dirnames, filenames) in os.walk(folder, topdown=True):
-                dirnames[:] = [d for d in dirnames if self.dir_filter(d)]
-                for f in filenames:
-                    fname = os.path.join(dirpath, f)
-                    if self.file_filter(fname):
-                        yield fname
+                    if project_exts is not None and ext not in project_exts:
+                        continue
+
+                    signature = WhooshManifest.entry_signature(entry)
+                except OSError:
+                    continue
+
+                self.stats.add("walk", timeit.default_timer() - start)
+                yield entry.path, signature
+                start = timeit.default_timer()
+
+
+    # os.walk based version for python without os.scandir
+    def walk_folder_compat(self, folder):
+        start = timeit.default_timer()
+        for (dirpath, dirnames, filenames) in os.walk(folder, topdown=True):
+            dirnames[:] = [d for d in dirnames if self.dir_filter(d)]
+            for f in filenames:
+                fname = os.path.join(dirpath, f)
+                if self.file_filter(fname, check_binary=False):
+                    signature = WhooshManifest.signature(fname)
+                    self.stats.add("walk", timeit.default_timer() - start)
+                    yield fname, signature
+                    start = timeit.default_timer()
+
+
+    # Binary check reads the head of every file. Run it on a bounded thread
+    # pool so that reads overlap with walking and indexing
+    def text_files(self, files):
+        pending = collections.deque()
+
+        def ready(limit):
+            while len(pending) > limit:
+                chunk, is_binary = pending.popleft()
+                for item, binary in zip(chunk, is_binary.result()):
+                    if not binary:
+                        yield item
+
+        with ThreadPoolExecutor(max_workers=_sniff_threads) as pool:
+            chunk = []
+            for item in files:
+                chunk.append(item)
+                if len(chunk) == _sniff_chunk:
+                    pending.append((chunk, pool.submit(self.sniff_files, chunk)))
+                    chunk = []
+                    yield from ready(_sniff_queue)
+            if chunk:
+                pending.append((chunk, pool.submit(self.sniff_files, chunk)))
+            yield from ready(0)
+
+
+    def sniff_files(self, files):
+        return [self.sniff_file(fname) for fname, _ in files]
+
+
+    def sniff_file(self, fname):
+        start = timeit.default_timer()
+        try:
+            return self.is_binary_file(fname)
+        except OSError:
+            # unreadable file is skipped as well
+            return True
+        finally:
+            self.stats.add("filter", timeit.default_timer() - start)
 
 
     def prepare_index_folder(self):
@@ -295,54 +871,36 @@ class WhooshInfrastructure():
         return self.project_name() + _index_folder_tag
 
 
-    def skip_dir(self, dirpath):
-        skip_folders = _settings.get("skip_folders")
-
-        if not skip_folders:
-            return False
+    # (skip_folders, skip_files, skip_file_extensions) sets, read from
+    # settings once per command
+    def path_filters(self):
+        if self._path_filters is None:
+            self._path_filters = tuple(frozenset(_settings.get(name) or ())
+                                       for name in ("skip_folders", "skip_files",
+                                                    "skip_file_extensions"))
+        return self._path_filters
 
-        folder_name = os.path.split(dirpath)[1]
 
-        for skip in skip_folders:
-            if folder_name == skip:
-                return True
-        return False
+    def skip_dir(self, dirpath):
+        return os.path.split(dirpath)[1] in self.path_filters()[0]
 
 
     def skip_file(self, fname):
-        skip_files = _settings.get("skip_files")
-
-        if not skip_files:
-            return False
-
-        if os.path.split(fname)[1] in skip_files:
-            return True
-
-        return False
+        return os.path.split(fname)[1] in self.path_filters()[1]
 
 
     def skip_file_ext(self, fname):
-        skip_exts = _settings.get("skip_file_extensions")
-
-        if not skip_exts:
-            return False
-
-        ext = os.path.splitext(fname)[1]
-
-        if ext[1:] in skip_exts:
-            return True
-
-        return False
+        return os.path.splitext(fname)[1][1:] in self.path_filters()[2]
 
 
-    def file_filter(self, fname):
+    def file_filter(self, fname, check_binary=True):
         if not os.path.isfile(fname):
             return False
 
         if self.is_hidden(fname):
             return False
 
-        if self.is_binary_file(fname):
+        if check_binary and self.is_binary_file(fname):
             return False
 
         if self.skip_file(fname):
@@ -351,14 +909,22 @@ class WhooshInfrastructure():
         if self.skip_file_ext(fname):
             return False
 
-        # for test artemn
-        if self.project_name() == "/home/artemn/linux/linux_4_3_3.sublime-project" and \
-           os.path.splitext(fname)[1] not in [".c", ".h"]:
+        project_exts = self.project_exts()
+        if project_exts is not None and os.path.splitext(fname)[1] not in project_exts:
             return False
 
         return True
 
 
+    # extensions of the only files to index in the project, both walkers use
+    # it. None indexes all files
+    def project_exts(self):
+        # for test artemn
+        if self.project_name() == "/home/artemn/linux/linux_4_3_3.sublime-project":
+            return (".c", ".h")
+        return None
+
+
     def dir_filter(self, dirpath):
         if self.is_hidden(dirpath):
             return False
@@ -368,17 +934,30 @@ class WhooshInfrastructure():
 
         return True
 
+    # time and size are columns, reading them does not unpickle stored fields
+    # stored content lives in a compressed column instead of the stored fields,
+    # so loading a hit's path never decompresses the file content
     def get_schema(self):
         if _settings.get("store_content", False):
-            return Schema (path=ID(unique=True, stored=True),
-                           time=STORED,
-                           content=TEXT(analyzer=CustomFancyAnalyzer(), chars=True, stored=True))
+            return Schema (path=ID(unique=True, stored=True, sortable=True),
+                           time=COLUMN(NumericColumn("d")),
+                           size=COLUMN(NumericColumn("q")),
+                           content=TEXT(analyzer=CustomFancyAnalyzer(), chars=True,
+                                        sortable=CompressedBlockColumn(level=1, blocksize=8)))
         else:
-            return Schema (path=ID(unique=True, stored=True),
-                           time=STORED,
+            return Schema (path=ID(unique=True, stored=True, sortable=True),
+                           time=COLUMN(NumericColumn("d")),
+                           size=COLUMN(NumericColumn("q")),
                            content=TEXT(analyzer=CustomFancyAnalyzer(), chars=True))
 
 
+    # indexes created before time and size became columns or with content
+    # in the stored fields have to be rebuilt
+    def index_outdated(self, ix):
+        schema = ix.schema
+        return "size" not in schema.names() or schema["content"].stored
+
+
     def is_hidden(self, filepath):
         name = os.path.basename(os.path.abspath(filepath))
         return name.startswith('.') or self.has_hidden_attribute(filepath)
@@ -394,23 +973,45 @@ class WhooshInfrastructure():
         return result
 
     def file_content(self, file_path):
-        with io.open(file_path, encoding="utf-8", errors="ignore") as f:
-            content = f.read()
-        return content
+        return file_content(file_path)
 
 
     def is_binary_file(self, file_path):
-        textchars = bytearray({7,8,9,10,12,13,27} | set(range(0x20, 0x100)) - {0x7f})
-        is_binary_string = lambda bytes: bool(bytes.translate(None, textchars))
-        with open(file_path, "rb") as f:
-            is_bin = is_binary_string(f.read(1024))
-        return is_bin
+        return is_binary_file(file_path)
+
+
+    def add_doc_to_index(self, writer, fname, update=False):
+        start = timeit.default_timer()
+        if isinstance(writer, MpWriter):
+            # sub-processes read, check and tokenize the file
+            writer.load_document(path=fname, check_binary=True)
+        elif update:
+            writer.update_document(**file_document(fname))
+        else:
+            writer.add_document(**file_document(fname))
+        self.stats.add("analyze", timeit.default_timer() - start)
 
 
-    def add_doc_to_index(self, writer, fname):
-        content = self.file_content(fname)
-        time = os.path.getmtime(fname)
-        writer.add_document(path=fname, content=content, time=time)
+    def index_procs(self):
+        procs = _settings.get("index_procs", 1)
+        if not procs:
+            procs = multiprocessing.cpu_count()
+        return max(procs, 1)
+
+
+    # new segments are written with binary posting blocks, segments written
+    # before keep being read with their own codec
+    def index_writer(self, ix, procs=1):
+        limitmb = _settings.get("ram_limit_mb", 1024)
+        if procs <= 1:
+            return ix.writer(limitmb=limitmb, codec=W3BinaryCodec(),
+                             timeout=_writer_lock_timeout)
+
+        # every sub-process has its own posting pool, so split the memory limit
+        subargs = {"limitmb" : max(limitmb // procs, 32), "codec" : W3BinaryCodec()}
+        return ix.writer(procs=procs, limitmb=limitmb, subargs=subargs,
+                         loader=file_document, codec=W3BinaryCodec(),
+                         timeout=_writer_lock_timeout)
 
 
 class WhooshIndex(WhooshInfrastructure):
@@ -428,82 +1029,117 @@ class WhooshIndex(WhooshInfrastructure):
         try:
             if not index.exists_in(index_path):
                 self.new_index(index_path)
+            elif self.index_outdated(index.open_dir(index_path)):
+                print("WhooshIndex: index format is outdated, rebuilding")
+                self.new_index(index_path)
             else:
                 self.incremental_index(index_path)
 
             stop = timeit.default_timer()
             print("WhooshIndex finished [%f s]" % (stop - start))
+            print("WhooshIndex stages: %s" % self.stats.report())
         except index.LockError:
             self.window.status_message("WhooshSearch: Index is locked")
+        except writing.IndexingError:
+            traceback.print_exc()
+            self.window.status_message("WhooshSearch: Indexing failed, see console")
 
 
     # Create the index from scratch
     def new_index(self, index_path):
-        self.status_message("Whoosh Indexing...")
-
+        # previous index size is the best guess of files to index
+        manifest = WhooshManifest(index_path)
+        manifest.load()
+        self.status_message("Whoosh Indexing", total=len(manifest.files))
+        manifest.delete()
+
+        stop_merger(index_path)
+        _searcher_pool.close(index_path)
         ix = index.create_in(index_path, schema=self.get_schema())
-        with ix.writer(limitmb=_settings.get("ram_limit_mb", 1024)) as writer:
-            file_count = 0
-            for fname in self.project_files():
+        procs = self.index_procs()
+        with self.index_writer(ix, procs) as writer:
+            # binary check is done by sub-processes in parallel mode
+            for fname, signature in self.project_files(check_binary=procs <= 1):
+                self.progress.advance(signature[1])
+                manifest.files[fname] = signature
                 self.add_doc_to_index(writer, fname)
-                file_count += 1
-                if file_count and file_count % 100 == 0:
-                    self.status_message("Whoosh Indexing: %d" % file_count)
-            self.status_message("Whoosh Commiting: %d" % file_count)
-
+            self.status_message("Whoosh Commiting: %d" % len(manifest.files))
+
+        if procs > 1:
+            # sub-processes skipped binary files, keep only indexed files
+            with ix.reader() as reader:
+                indexed = set(reader.field_terms("path"))
+            manifest.files = {path : signature for path, signature
+                              in manifest.files.items() if path in indexed}
+
+        # all index jobs of the project run on one worker, nobody can write
+        # the index between commit and manifest saving
+        manifest.save()
         self.status_message("")
 
         return ix
 
 
-    # TODO should consider changes of settings to filter files and folders
     def incremental_index(self, index_path):
         ix = index.open_dir(index_path)
+        manifest = WhooshManifest(index_path)
+
+        self.status_message("Whoosh Indexing")
+
+        writer = self.index_writer(ix)
+        try:
+            if not manifest.load():
+                # manifest was not saved (e.g. indexing was cancelled),
+                # read it once from the index columns
+                self.load_manifest(ix, manifest)
+
+            # Loop over the files in the filesystem. Unchanged files were
+            # checked for binary content when they were indexed
+            project_files = {}
+            for path, signature in self.project_files(check_binary=False):
+                self.progress.check()
+                if manifest.changed(path, signature):
+                    if self.sniff_file(path):
+                        continue
+                    self.progress.advance(signature[1])
+                    self.add_doc_to_index(writer, path, update=path in manifest.files)
+                project_files[path] = signature
+
+            # Files which were deleted or filtered out since they were indexed
+            for path in manifest.files:
+                if path not in project_files:
+                    writer.delete_by_term('path', path)
+        except:
+            writer.cancel()
+            raise
+
+        self.status_message("Whoosh Commit: %d" % self.progress.done)
+        # the background merger is the only one to merge segments, a merge
+        # here could delete segments a background merge is reading
+        writer.commit(merge=False)
+        index_merger(index_path).start()
+
+        # saved files which were not committed yet are reindexed above,
+        # their manifest signatures are not updated until commit
+        _searcher_pool.drop_recent(index_path)
+        manifest.files = project_files
+        manifest.save()
+        self.status_message("")
 
-        # The set of all paths in the index
-        indexed_paths = set()
-        # The set of all paths we need to re-index
-        to_index = set()
+        return ix
 
-        self.status_message("Whoosh Indexing...")
 
+    def load_manifest(self, ix, manifest):
         with ix.searcher() as searcher:
-            with ix.writer(limitmb=_settings.get("ram_limit_mb", 1024)) as writer:
-                # Loop over the stored fields in the index
-                for fields in searcher.all_stored_fields():
-                    indexed_path = fields['path']
-                    indexed_paths.add(indexed_path)
-
-                    if not os.path.exists(indexed_path) or not self.file_filter(indexed_path):
-                        # This file was deleted since it was indexed
-                        writer.delete_by_term('path', indexed_path)
-                    else:
-                        # Check if this file was changed since it
-                        # was indexed
-                        indexed_time = fields['time']
-                        mtime = os.path.getmtime(indexed_path)
-                        if mtime > indexed_time:
-                            # The file has changed, delete it and add it to the list of
-                            # files to reindex
-                            writer.delete_by_term('path', indexed_path)
-                            to_index.add(indexed_path)
-
-                # Loop over the files in the filesystem
-                # Assume we have a function that gathers the filenames of the
-                # documents to be indexed
-                file_count = 0
-                for path in self.project_files():
-                    if path in to_index or path not in indexed_paths:
-                        # This is either a file that's changed, or a new file
-                        # that wasn't indexed before. So index it!
-                        self.add_doc_to_index(writer, path)
-                        file_count += 1
-                    if file_count and file_count % 100 == 0:
-                        self.status_message("Whoosh Indexing: %d" % file_count)
-                self.status_message("Whoosh Commit: %d" % file_count)
-            self.status_message("")
+            reader = searcher.reader()
+            if not reader.doc_count_all():
+                return
 
-        return ix
+            paths = reader.column_reader("path")
+            times = reader.column_reader("time")
+            sizes = reader.column_reader("size")
+            for docnum in reader.all_doc_ids():
+                manifest.add_indexed(paths[docnum], times[docnum], sizes[docnum])
 
 
 class WhooshReset(WhooshIndex):
@@ -522,22 +1158,33 @@ class WhooshReset(WhooshIndex):
 
             stop = timeit.default_timer()
             print("WhooshReset finished [%f s]" % (stop - start))
+            print("WhooshReset stages: %s" % self.stats.report())
         except index.LockError:
             self.window.status_message("WhooshSearch: Index is locked")
+        except writing.IndexingError:
+            traceback.print_exc()
+            self.window.status_message("WhooshSearch: Indexing failed, see console")
 
 
 class WhooshSave(WhooshInfrastructure):
-    def __init__(self, window, file_name):
+    def __init__(self, window, file_names):
         WhooshInfrastructure.__init__(self, window)
-        self.file_name = file_name
+        self.file_names = set(file_names)
 
     def __call__(self):
         if not self.is_project():
             self.window.status_message("WhooshSearch indexes only projects")
             return
 
-        if self.belongs_project(self.file_name):
-            self.reindex()
+        # a file deleted or renamed since it was saved is removed from the
+        # index if it was indexed
+        file_names = [f for f in self.file_names
+                      if not os.path.exists(f) or self.belongs_project(f)]
+        if file_names:
+            self.reindex(file_names)
+
+    def merge(self, job):
+        self.file_names |= job.file_names
 
     def belongs_project(self, file_name):
         result = False
@@ -565,37 +1212,139 @@ class WhooshSave(WhooshInfrastructure):
 
         return True
 
-    def reindex(self):
+    # reindex all changed files in one writer transaction
+    def reindex(self, file_names):
         index_path = self.prepare_index_folder()
         ix = index.open_dir(index_path)
+        if self.index_outdated(ix):
+            # the index job rebuilds the index with saved files too
+            self.window.status_message("WhooshSearch: Index format is outdated, rebuilding")
+            WhooshIndex(self.window).submit(("index",), covered_by=(("reset",),))
+            return
 
-        try:
-            with ix.searcher() as searcher:
-                with ix.writer(limitmb=_settings.get("ram_limit_mb", 1024)) as writer:
-                    fields = searcher.document(path=self.file_name)
+        manifest = WhooshManifest(index_path)
+        manifest.load_paths(file_names)
+        recent = _searcher_pool.recent_files(index_path)
+
+        # signature of a deleted file is None
+        changed = {}
+        for file_name in file_names:
+            signature = (manifest.signature(file_name)
+                         if os.path.exists(file_name) else None)
+            if file_name in recent:
+                if recent[file_name] != signature:
+                    changed[file_name] = signature
+            elif signature is None:
+                if file_name in manifest.files:
+                    changed[file_name] = signature
+            elif manifest.changed(file_name, signature):
+                changed[file_name] = signature
+
+        if not changed:
+            #nothing to reindex
+            self.window.status_message("Whoosh Saving: nothing to save")
+            return
 
-                    if fields:
-                        if os.path.getmtime(self.file_name) == fields['time']:
-                            #nothing to reindex
-                            self.window.status_message("Whoosh Saving: nothing to save")
-                            return
+        if len(changed) == 1:
+            self.status_message("Whoosh Saving: %s" % os.path.split(next(iter(changed)))[1])
+        else:
+            self.status_message("Whoosh Saving", total=len(changed))
 
-                    writer.delete_by_term('path', self.file_name)
-                    self.add_doc_to_index(writer, self.file_name)
+        if (_settings.get("near_real_time", True)
+                and len(set(recent) | set(changed)) < _recent_max_files):
+            self.add_recent(index_path, ix, changed)
+        else:
+            self.commit_files(index_path, ix, changed)
 
-                    self.status_message("Whoosh Saving: %s" % os.path.split(self.file_name)[1])
+        self.status_message("")
+
+    # saved files are searchable at once, but the index folder is not changed
+    def add_recent(self, index_path, ix, changed):
+        documents = {}
+        for file_name, signature in changed.items():
+            if signature is None or not os.path.exists(file_name):
+                # only older versions of the deleted file are masked
+                changed[file_name] = None
+                continue
+            self.progress.advance(signature[1])
+            documents[file_name] = file_document(file_name)
+
+        created = _searcher_pool.add_recent(index_path, ix.schema, changed, documents)
+        if created is not None:
+            project_worker(self.project_name()).flush_recent_later(self.window, created)
+
+    # commits changed files and files of the memory segment in one writer
+    # transaction
+    def commit_files(self, index_path, ix, changed):
+        manifest = WhooshManifest(index_path)
+        manifest.load()
+
+        files = {}
+        for file_name in _searcher_pool.recent_files(index_path):
+            # the file may be changed or deleted since it was saved
+            files[file_name] = (manifest.signature(file_name)
+                                if os.path.exists(file_name) else None)
+        files.update(changed)
 
-                self.status_message("")
+        try:
+            writer = self.index_writer(ix)
+            try:
+                for file_name, signature in files.items():
+                    if signature is None:
+                        writer.delete_by_term("path", file_name)
+                        manifest.files.pop(file_name, None)
+                        continue
+                    self.progress.advance(signature[1])
+                    writer.update_document(**file_document(file_name))
+            except:
+                writer.cancel()
+                raise
+
+            # segments of saves are merged in the background, a save never
+            # waits for a merge
+            writer.commit(merge=False)
+            _searcher_pool.drop_recent(index_path)
+            index_merger(index_path).start()
+
+            # index built without manifest gets it from the next incremental index
+            if manifest.loaded:
+                manifest.files.update((f, s) for f, s in files.items() if s is not None)
+                manifest.save()
 
         except index.LockError:
             self.window.status_message("WhooshSearch: Index is locked")
 
 
+# WhooshFlush commits the memory segment of saved files to the index folder
+# if it was created at created time or before
+class WhooshFlush(WhooshSave):
+    def __init__(self, window, created):
+        WhooshSave.__init__(self, window, ())
+        self.created = created
+
+    def __call__(self):
+        if not self.is_project():
+            return
+
+        index_path = self.prepare_index_folder()
+        if not _searcher_pool.recent_files(index_path, self.created):
+            return
+
+        self.status_message("Whoosh Saving")
+        self.commit_files(index_path, index.open_dir(index_path), {})
+        self.status_message("")
+
+    def merge(self, job):
+        self.created = max(self.created, job.created)
+
+
 class WhooshSearch(WhooshInfrastructure):
     def __init__(self, window, search_string):
         WhooshInfrastructure.__init__(self, window)
         self.search_string = search_string
         self.whoosh_view = None
+        self.render_buffer = []
+        self.render_size = 0
 
     def __call__(self):
         start = timeit.default_timer()
@@ -608,15 +1357,11 @@ class WhooshSearch(WhooshInfrastructure):
             self.window.status_message("WhooshSearch: Please create the index")
             return
 
-        ix = index.open_dir(self.index_folder())
-        qp = QueryParser("content", schema=ix.schema)
+        with _searcher_pool.searcher(self.index_folder()) as (searcher, qp, mask):
+            # Search for phrases. search_string should to be in quotes
+            q = qp.parse('"%s"' % self.search_string)
 
-        # Search for phrases. search_string should to be in quotes
-        q = qp.parse('"%s"' % self.search_string)
-
-        with ix.searcher() as searcher:
-            hits = searcher.search(q, limit=None, terms=True)
-            self.show_hits(hits)
+            self.show_hits(searcher, q, mask)
 
         stop = timeit.default_timer()
         print("WhooshSearch finished [%f s]" % (stop - start))
@@ -654,49 +1399,57 @@ class WhooshSearch(WhooshInfrastructure):
         self.whoosh_view.run_command("whoosh_view_clear_all")
 
 
-    def display_filepath(self, filepath):
+    # Rendered text is collected and appended to the view in large chunks,
+    # every append is a round-trip to the main thread
+    def render(self, text):
+        self.render_buffer.append(text)
+        self.render_size += len(text)
+        if self.render_size >= _render_chunk_size:
+            self.flush()
+
+
+    def flush(self):
+        if not self.render_buffer:
+            return
+
         self.whoosh_view.run_command("whoosh_view_append_text",
-                                     {"text" : "\n%s:\n" % filepath, "search_string" : None})
+                                     {"text" : "".join(self.render_buffer),
+                                      "search_string" : self.search_string})
+        self.render_buffer = []
+        self.render_size = 0
+
+
+    def display_filepath(self, filepath):
+        self.render("\n%s:\n" % filepath)
 
 
     def display_fragments(self, fragments):
-        line_count_start = 0
-        line_count = 0
         for fragment in fragments:
-            line_count += fragment.text.count('\n', line_count_start, fragment.startchar)
-            text = '%8d:\t' % (line_count + 1)
+            text = '%8d:\t' % fragment.line
             text += fragment.text[fragment.startchar : fragment.endchar] + '\n';
-            line_count_start = fragment.startchar
-            self.whoosh_view.run_command("whoosh_view_append_text",
-                                         {"text" : text, "search_string" : self.search_string})
+            self.render(text)
 
 
     def display_header(self, file_number):
         header = 'Searching %d files for "%s"\n' % (file_number, self.search_string)
         self.whoosh_view.run_command("whoosh_view_append_text",
-                                     {"text" : header, "search_string" : self.search_string})
+                                     {"text" : header, "search_string" : None})
 
 
     def display_footer(self, hit_count):
-        regions = self.whoosh_view.find_all(self.search_string,
-                                            sublime.LITERAL | sublime.IGNORECASE)
-        reg_num = len(regions) - 1
+        self.flush()
+        reg_num = len(self.whoosh_view.get_regions('whoosh_regions'))
 
-        text = "\n%d matches across %d files\n" % (reg_num if reg_num >= 0 else 0, hit_count)
+        text = "\n%d matches across %d files\n" % (reg_num, hit_count)
         self.whoosh_view.run_command("whoosh_view_append_text",
                                      {"text" : text, "search_string" : None})
 
 
-    def show_hits(self, hits):
-        self.setup_hits(hits)
-        self.open_whoosh_view()
-        self.clear_whoosh_view()
-
-        self.display_header(hits.searcher.doc_count())
-
+    # displays a page of hits of the results set up by setup_hits
+    def display_hits(self, hits, contents):
         for hit in hits:
-            if _settings.get("store_content", False) and "content" in hit:
-                content = hit["content"]
+            if contents is not None:
+                content = contents[hit.docnum]
             else:
                 content = self.file_content(hit["path"])
 
@@ -704,7 +1457,28 @@ class WhooshSearch(WhooshInfrastructure):
             self.display_filepath(hit["path"])
             self.display_fragments(fragments)
 
-        self.display_footer(len(hits))
+
+    # mask is a set of docnums of outdated documents or None
+    def show_hits(self, searcher, q, mask=None):
+        self.open_whoosh_view()
+        self.clear_whoosh_view()
+
+        self.display_header(searcher.doc_count() - len(mask or ()))
+
+        # stored content is decompressed only for the hits being displayed
+        reader = searcher.reader()
+        contents = None
+        if reader.has_column("content"):
+            contents = reader.column_reader("content", translate=True)
+
+        # search once, paint the best files at once, then fill in the rest
+        hits = searcher.search(q, limit=None, terms=True, mask=mask)
+        self.setup_hits(hits)
+        self.display_hits(hits[:_first_page_files], contents)
+        self.flush()
+        self.display_hits(hits[_first_page_files:], contents)
+
+        self.display_footer(hits.scored_length())
         self.block_view()
 
     def block_view(self):
@@ -730,7 +1504,7 @@ def refresh_whoosh_input(search_string):
 class WhooshIndexCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         whoosh_index = WhooshIndex(sublime.active_window())
-        threading.Thread(target=whoosh_index).start()
+        whoosh_index.submit(("index",), covered_by=(("reset",),))
 
 
 class WhooshSearchPromptCommand(sublime_plugin.WindowCommand):
@@ -772,14 +1546,26 @@ class WhooshSearchCommand(sublime_plugin.WindowCommand):
 
 class WhooshResetCommand(sublime_plugin.TextCommand):
     def run(self, edit):
+        # rebuilding from scratch makes running or queued rebuilds useless
         whoosh_reset = WhooshReset(sublime.active_window())
-        threading.Thread(target=whoosh_reset).start()
+        whoosh_reset.submit(("reset",), cancel=(("index",), ("reset",)))
+
+
+class WhooshCancelCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        project_name = self.window.project_file_name()
+        if not project_name or not project_worker(project_name).cancel():
+            self.window.status_message("WhooshSearch: Nothing to cancel")
 
 
 class WhooshEventListener(sublime_plugin.EventListener):
     def on_post_save(self, view):
-        whoosh_save = WhooshSave(sublime.active_window(), view.file_name())
-        threading.Thread(target=whoosh_save).start()
+        window = sublime.active_window()
+        if not window.project_file_name():
+            window.status_message("WhooshSearch indexes only projects")
+            return
+
+        project_worker(window.project_file_name()).save_later(window, view.file_name())
 
 
 class WhooshViewAppendTextCommand(sublime_plugin.TextCommand):
@@ -788,14 +1574,20 @@ class WhooshViewAppendTextCommand(sublime_plugin.TextCommand):
         self.view.insert(edit, start_point, text)
 
         if search_string is not None:
-            regions = self.view.find_all(search_string,
-                                    sublime.LITERAL | sublime.IGNORECASE)
-            self.view.add_regions('whoosh_regions', regions[1:], "text.find-in-files", "", sublime.DRAW_OUTLINED)
+            # only the appended text is searched, earlier regions are kept
+            regions = self.view.get_regions('whoosh_regions')
+            flags = sublime.LITERAL | sublime.IGNORECASE
+            region = self.view.find(search_string, start_point, flags)
+            while region and region.a >= 0:
+                regions.append(region)
+                region = self.view.find(search_string, region.b, flags)
+            self.view.add_regions('whoosh_regions', regions, "text.find-in-files", "", sublime.DRAW_OUTLINED)
 
 
 class WhooshViewClearAllCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         self.view.erase(edit, sublime.Region(0, self.view.size()))
+        self.view.erase_regions('whoosh_regions')
 
 
 class WhooshArrowUpCommand(sublime_plugin.TextCommand):
@@ -235,6 +235,26 @@ class FieldWriter(object):
         if lastfn is not None:
             finish_field()
 
+    def add_merged_postings(self, schema, lengths, items, readers):
+        # Like add_postings(), but also writes the postings of existing
+        # segments being merged into the new one. "readers" is a list of
+        # (reader, startdoc, docmap) tuples in the order their documents were
+        # added to the new segment: a document's new number is
+        # docmap[docnum], or startdoc + docnum if docmap is None.
+        #
+        # Each reader's postings are already sorted, and its documents come
+        # after the ones in "items" and the earlier readers, so the sorted
+        # streams only need to be merged, not sorted again. Codecs can
+        # override this to copy postings more directly.
+
+        from WhooshSearch.whoosh.externalsort import imerge
+
+        sources = [items]
+        for reader, startdoc, docmap in readers:
+            sources.append(_renumber_postings(schema, reader.iter_postings(),
+                                              startdoc, docmap))
+        self.add_postings(schema, lengths, imerge(sources))
+
     @abstractmethod
     def start_field(self, fieldname, fieldobj):
         raise NotImplementedError
@@ -261,6 +281,21 @@ class FieldWriter(object):
         pass
 
 
+def _renumber_postings(schema, items, startdoc, docmap):
+    # Gives the postings of a reader being merged their new document numbers,
+    # dropping fields that are no longer in the schema
+    for fieldname, btext, docnum, weight, value in items:
+        if fieldname not in schema:
+            continue
+        if docmap is not None:
+            docnum = docmap[docnum]
+        else:
+            docnum += startdoc
+        if value is None:
+            value = emptybytes
+        yield (fieldname, btext, docnum, weight, value)
+
+
 # Postings
 
 class PostingsWriter(object):
@@ -316,6 +351,17 @@ class TermsReader(object):
     def terms_from(self, fieldname, prefix):
         raise NotImplementedError
 
+    def expand_prefix(self, fieldname, prefix):
+        """Yields the term bytes in the given field that start with the given
+        prefix bytes. Subclasses can override this with something faster than
+        filtering :meth:`TermsReader.terms_from`.
+        """
+
+        for fname, btext in self.terms_from(fieldname, prefix):
+            if fname != fieldname or not btext.startswith(prefix):
+                return
+            yield btext
+
     @abstractmethod
     def items(self):
         raise NotImplementedError
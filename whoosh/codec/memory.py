@@ -39,6 +39,8 @@ from WhooshSearch.whoosh.writing import SegmentWriter
 class MemWriter(SegmentWriter):
     def commit(self):
         self._finalize_segment()
+        self._tempstorage.destroy()
+        self.is_closed = True
 
 
 class MemoryCodec(base.Codec):
@@ -49,7 +51,10 @@ class MemoryCodec(base.Codec):
         self.segment = MemSegment(self, "blah")
 
     def writer(self, schema):
-        ix = self.storage.create_index(schema)
+        # Name the index after the segment, so the writer's temporary folder
+        # isn't shared with other writers
+        ix = self.storage.create_index(schema,
+                                       indexname=self.segment.segment_id())
         return MemWriter(ix, _lk=False, codec=self,
                          docbase=self.segment._doccount)
 
@@ -77,18 +82,24 @@ class MemPerDocWriter(base.PerDocWriterWithColumns):
         self._storage = storage
         self._segment = segment
         self.is_closed = False
-        self._colwriters = {}
         self._doccount = 0
 
     def _has_column(self, fieldname):
-        return fieldname in self._colwriters
+        return fieldname in self._segment._columns
 
     def _create_column(self, fieldname, column):
-        colfile = self._storage.create_file("%s.c" % fieldname)
-        self._colwriters[fieldname] = (colfile, column.writer(colfile))
+        with self._segment._lock:
+            self._segment._columns[fieldname] = (column, {})
 
     def _get_column(self, fieldname):
-        return self._colwriters[fieldname][1]
+        return self._segment._columns[fieldname][1]
+
+    def add_column_value(self, fieldname, column, value):
+        # The values are kept in the segment, so a later writer can rewrite
+        # the column files with the documents of every writer
+        if not self._has_column(fieldname):
+            self._create_column(fieldname, column)
+        self._get_column(fieldname)[self._docnum] = value
 
     def start_doc(self, docnum):
         self._doccount += 1
@@ -114,11 +125,18 @@ class MemPerDocWriter(base.PerDocWriterWithColumns):
             self._segment._vectors[docnum] = self._vectors
 
     def close(self):
-        colwriters = self._colwriters
-        for fieldname in colwriters:
-            colfile, colwriter = colwriters[fieldname]
-            colwriter.finish(self._doccount)
-            colfile.close()
+        segment = self._segment
+        if self._doccount:
+            doccount = self._docnum + 1
+            with segment._lock:
+                columns = list(segment._columns.items())
+            for fieldname, (column, values) in columns:
+                colfile = self._storage.create_file("%s.c" % fieldname)
+                colwriter = column.writer(colfile)
+                for docnum in sorted(values):
+                    colwriter.add(docnum, values[docnum])
+                colwriter.finish(doccount)
+                colfile.close()
         self.is_closed = True
 
 
@@ -276,7 +294,9 @@ class MemTermsReader(base.TermsReader):
     def matcher(self, fieldname, btext, format_, scorer=None):
         items = self._invindex[fieldname][btext]
         ids, weights, values = zip(*items)
-        return ListMatcher(ids, weights, values, format_, scorer=scorer)
+        terminfo = self._segment._terminfos[fieldname, btext]
+        return ListMatcher(ids, weights, values, format_, scorer=scorer,
+                           term=(fieldname, btext), terminfo=terminfo)
 
     def indexed_field_names(self):
         return self._invindex.keys()
@@ -295,6 +315,8 @@ class MemSegment(base.Segment):
         self._vectors = {}
         self._invindex = {}
         self._terminfos = {}
+        # {fieldname: (column, {docnum: value})}
+        self._columns = {}
         self._lock = Lock()
 
     def codec(self):
@@ -321,6 +343,10 @@ class MemSegment(base.Segment):
         with self._lock:
             return self._doccount - len(self._stored)
 
+    def deleted_count(self):
+        with self._lock:
+            return self._doccount - len(self._stored)
+
     def is_deleted(self, docnum):
         return docnum not in self._stored
 
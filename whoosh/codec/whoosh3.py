@@ -32,19 +32,25 @@ This module implements a "codec" for writing/reading Whoosh X indexes.
 import struct
 from array import array
 from collections import defaultdict
+from itertools import accumulate, chain
 
 from WhooshSearch.whoosh import columns, formats
 from WhooshSearch.whoosh.compat import b, bytes_type, string_type, integer_types
 from WhooshSearch.whoosh.compat import dumps, loads, iteritems, xrange
+from WhooshSearch.whoosh.compat import array_tobytes, array_frombytes
 from WhooshSearch.whoosh.codec import base
+from WhooshSearch.whoosh.externalsort import imerge
 from WhooshSearch.whoosh.filedb import compound, filetables
 from WhooshSearch.whoosh.matching import ListMatcher, ReadTooFar, LeafMatcher
 from WhooshSearch.whoosh.reading import TermInfo, TermNotFound
-from WhooshSearch.whoosh.system import emptybytes
+from WhooshSearch.whoosh.system import emptybytes, IS_LITTLE
 from WhooshSearch.whoosh.system import _SHORT_SIZE, _INT_SIZE, _LONG_SIZE, _FLOAT_SIZE
 from WhooshSearch.whoosh.system import pack_ushort, unpack_ushort
 from WhooshSearch.whoosh.system import pack_int, unpack_int, pack_long, unpack_long
+from WhooshSearch.whoosh.util.bloom import BloomFilter, key_hashes
+from WhooshSearch.whoosh.util.cache import SizedLRUCache
 from WhooshSearch.whoosh.util.numlists import delta_encode, delta_decode
+from WhooshSearch.whoosh.util.numlists import pfor_encode, pfor_decode, pfor_length
 from WhooshSearch.whoosh.util.numeric import length_to_byte, byte_to_length
 
 try:
@@ -56,6 +62,8 @@ except ImportError:
 # This byte sequence is written at the start of a posting list to identify the
 # codec/version
 WHOOSH3_HEADER_MAGIC = b("W3Bl")
+# This byte sequence starts a posting list written by W3BinaryCodec
+WHOOSH3_BINARY_MAGIC = b("W3Bb")
 
 # Column type to store field length info
 LENGTHS_COLUMN = columns.NumericColumn("B", default=0)
@@ -66,6 +74,12 @@ VECTOR_LEN_COLUMN = columns.NumericColumn("i")
 # Column type to store values of stored fields
 STORED_COLUMN = columns.PickleColumn(columns.CompressedBytesColumn())
 
+# Decoded posting blocks, shared by the matchers of every open segment so hot
+# terms aren't decompressed and decoded again on every search. The budget can
+# be changed by setting block_cache.maxbytes (0 turns the cache off), and the
+# hit/miss counters are in block_cache.cache_info()
+block_cache = SizedLRUCache(16 * 1024 * 1024)
+
 
 class W3Codec(base.Codec):
     # File extensions
@@ -74,10 +88,23 @@ class W3Codec(base.Codec):
     VPOSTS_EXT = ".vps"  # Vector postings
     COLUMN_EXT = ".col"  # Per-document value columns
 
-    def __init__(self, blocklimit=128, compression=3, inlinelimit=1):
+    def __init__(self, blocklimit=128, compression=3, inlinelimit=1,
+                 bloombits=10):
+        """
+        :param blocklimit: the maximum number of postings in each block.
+        :param compression: the zlib compression level of the blocks.
+        :param inlinelimit: the maximum number of postings to store inline
+            in the term info instead of in a block.
+        :param bloombits: the number of bits per term of the Bloom filter
+            written for each field of a segment, which lets readers skip the
+            term dictionary for terms the segment doesn't contain (about 1%
+            false positives at 10 bits). Use 0 to not write filters.
+        """
+
         self._blocklimit = blocklimit
         self._compression = compression
         self._inlinelimit = inlinelimit
+        self._bloombits = bloombits
 
     # def automata(self):
 
@@ -96,7 +123,8 @@ class W3Codec(base.Codec):
                                 byteids=byteids, compression=self._compression,
                                 inlinelimit=self._inlinelimit)
 
-    def postings_reader(self, dbfile, terminfo, format_, term=None, scorer=None):
+    def postings_reader(self, dbfile, terminfo, format_, term=None, scorer=None,
+                        segid=None):
         if terminfo.is_inlined():
             # If the postings were inlined into the terminfo object, pull them
             # out and use a ListMatcher to wrap them in a Matcher interface
@@ -106,7 +134,7 @@ class W3Codec(base.Codec):
         else:
             offset, length = terminfo.extent()
             m = W3LeafMatcher(dbfile, offset, length, format_, term=term,
-                              scorer=scorer)
+                              scorer=scorer, segid=segid)
         return m
 
     # Readers
@@ -121,7 +149,8 @@ class W3Codec(base.Codec):
 
         postfile = segment.open_file(storage, self.POSTS_EXT)
 
-        return W3TermsReader(self, tifile, tilen, postfile)
+        return W3TermsReader(self, tifile, tilen, postfile,
+                             segid=segment.segment_id())
 
     # Graph methods provided by CodecWithGraph
 
@@ -141,6 +170,74 @@ class W3Codec(base.Codec):
         return W3Segment(self, indexname)
 
 
+class W3BinaryCodec(W3Codec):
+    """Variant of :class:`W3Codec` that writes posting blocks as raw arrays
+    behind a fixed-width header instead of pickled tuples, so reading a block
+    never goes through the pickle machine. Only the values section is
+    compressed, so matching on IDs and weights doesn't touch zlib either.
+
+    Vector postings (which have byte string IDs) keep the W3Codec block
+    format.
+    """
+
+    def __init__(self, blocklimit=128, compression=3, inlinelimit=1,
+                 pfor=False, frontcoded=True, bloombits=10):
+        """
+        :param pfor: if True, pack the ID gaps of a block with patched frame
+            of reference (see :func:`whoosh.util.numlists.pfor_encode`)
+            whenever that is smaller than a plain array. This makes the IDs
+            smaller but slower to decode without NumPy.
+        :param frontcoded: if True, write the term dictionary as a front-coded
+            file (see :class:`whoosh.filedb.filetables.FrontCodedWriter`)
+            instead of an ordered hash file. This makes the terms file much
+            smaller and prefix, range and automaton (fuzzy) term expansion
+            faster, at the cost of slightly slower exact term lookups.
+        """
+
+        W3Codec.__init__(self, blocklimit=blocklimit, compression=compression,
+                         inlinelimit=inlinelimit, bloombits=bloombits)
+        self._pfor = pfor
+        self._frontcoded = frontcoded
+
+    # Segments written by earlier versions of this codec don't have the
+    # newer attributes, so they're read with getattr() and a default
+
+    def field_writer(self, storage, segment):
+        if getattr(self, "_frontcoded", False):
+            return W3FrontCodedFieldWriter(self, storage, segment)
+        return W3Codec.field_writer(self, storage, segment)
+
+    def postings_writer(self, dbfile, byteids=False):
+        if byteids:
+            return W3Codec.postings_writer(self, dbfile, byteids=True)
+        return W3BinaryPostingsWriter(dbfile, blocklimit=self._blocklimit,
+                                      compression=self._compression,
+                                      inlinelimit=self._inlinelimit,
+                                      pfor=getattr(self, "_pfor", False))
+
+    def postings_reader(self, dbfile, terminfo, format_, term=None, scorer=None,
+                        segid=None):
+        if terminfo.is_inlined():
+            return W3Codec.postings_reader(self, dbfile, terminfo, format_,
+                                           term=term, scorer=scorer)
+        offset, length = terminfo.extent()
+        return W3BinaryLeafMatcher(dbfile, offset, length, format_, term=term,
+                                   scorer=scorer, segid=segid)
+
+    def terms_reader(self, storage, segment):
+        if not getattr(self, "_frontcoded", False):
+            return W3Codec.terms_reader(self, storage, segment)
+
+        tiname = segment.make_filename(self.TERMS_EXT)
+        tilen = storage.file_length(tiname)
+        tifile = storage.open_file(tiname)
+
+        postfile = segment.open_file(storage, self.POSTS_EXT)
+
+        return W3FrontCodedTermsReader(self, tifile, tilen, postfile,
+                                       segid=segment.segment_id())
+
+
 # Common functions
 
 def _vecfield(fieldname):
@@ -159,8 +256,12 @@ class W3PerDocWriter(base.PerDocWriterWithColumns):
         self._storage = storage
         self._segment = segment
 
-        tempst = storage.temp_storage("%s.tmp" % segment.indexname)
-        self._cols = compound.CompoundWriter(tempst)
+        # Column data is buffered in a temporary folder of the segment, so
+        # a writer finishing in the meantime (e.g. while a background merge
+        # writes its segment) can't clean it up
+        self._tempstorage = storage.temp_storage("%s.tmp"
+                                                 % segment.segment_id())
+        self._cols = compound.CompoundWriter(self._tempstorage)
         self._colwriters = {}
         self._create_column("_stored", STORED_COLUMN)
 
@@ -265,6 +366,7 @@ class W3PerDocWriter(base.PerDocWriterWithColumns):
         for writer in self._colwriters.values():
             writer.finish(self._doccount)
         self._cols.save_as_files(self._storage, self._column_filename)
+        self._tempstorage.destroy()
 
         # If vectors were written, close the vector writers
         if self._vpostfile:
@@ -286,9 +388,15 @@ class W3FieldWriter(base.FieldWriter):
         self._format = None
 
         _tifile = self._create_file(W3Codec.TERMS_EXT)
-        self._tindex = filetables.OrderedHashWriter(_tifile)
+        self._tindex = self._terms_index_writer(_tifile)
         self._fieldmap = self._tindex.extras["fieldmap"] = {}
 
+        # Hashes of the terms of each field, turned into Bloom filters when
+        # the writer is closed. Codecs pickled before filters existed don't
+        # have the attribute, but new segments still get filters
+        self._bloombits = getattr(codec, "_bloombits", 10)
+        self._termhashes = {}
+
         self._postfile = self._create_file(W3Codec.POSTS_EXT)
 
         self._postwriter = None
@@ -298,6 +406,9 @@ class W3FieldWriter(base.FieldWriter):
     def _create_file(self, ext):
         return self._segment.create_file(self._storage, ext)
 
+    def _terms_index_writer(self, dbfile):
+        return filetables.OrderedHashWriter(dbfile)
+
     def start_field(self, fieldname, fieldobj):
         fmap = self._fieldmap
         if fieldname in fmap:
@@ -310,6 +421,8 @@ class W3FieldWriter(base.FieldWriter):
         self._fieldobj = fieldobj
         self._format = fieldobj.format
         self._infield = True
+        if self._bloombits and fieldname not in self._termhashes:
+            self._termhashes[fieldname] = (array("I"), array("I"))
 
         # Start a new postwriter for this field
         self._postwriter = self._codec.postings_writer(self._postfile)
@@ -331,6 +444,12 @@ class W3FieldWriter(base.FieldWriter):
         valbytes = terminfo.to_bytes()
         self._tindex.add(keybytes, valbytes)
 
+        if self._bloombits:
+            h1s, h2s = self._termhashes[self._fieldname]
+            h1, h2 = key_hashes(self._btext)
+            h1s.append(h1)
+            h2s.append(h2)
+
     # FieldWriterWithGraph.add_spell_word
 
     def finish_field(self):
@@ -339,12 +458,192 @@ class W3FieldWriter(base.FieldWriter):
         self._infield = False
         self._postwriter = None
 
+    def add_merged_postings(self, schema, lengths, items, readers):
+        # Walks the terms of the new postings and of each segment being merged
+        # in step, so nothing is sorted again. Posting blocks in the binary
+        # format are copied over with only the document numbers in their
+        # headers changed, unless a deleted document falls inside the block
+
+        sources = [_grouped_postings(items, 0)]
+        termsreaders = []
+        try:
+            for srcnum, (reader, startdoc, docmap) in enumerate(readers, 1):
+                codec = reader.codec()
+                segment = reader.segment()
+                terms = None
+                if codec is not None and segment is not None:
+                    terms = codec.terms_reader(reader.storage(), segment)
+                if isinstance(terms, W3TermsReader):
+                    termsreaders.append(terms)
+                    sources.append(_segment_terms(schema, terms, srcnum,
+                                                  startdoc, docmap))
+                else:
+                    if terms is not None:
+                        terms.close()
+                    postings = base._renumber_postings(
+                        schema, reader.iter_postings(), startdoc, docmap)
+                    sources.append(_grouped_postings(postings, srcnum))
+
+            self._add_merged_terms(schema, lengths, imerge(sources))
+        finally:
+            for terms in termsreaders:
+                terms.close()
+
+    def _add_merged_terms(self, schema, lengths, merged):
+        if lengths:
+            dfl = lengths.doc_field_length
+        else:
+            dfl = lambda docnum, fieldname: 0
+
+        # A term is only started when it gets its first posting, since all
+        # the documents of a term in a merged segment may have been deleted
+        lastfn = None
+        lasttext = None
+        self._pendingterm = None
+        # Look one source ahead to know if a source is the last one with the
+        # current term
+        merged = iter(merged)
+        nextitem = next(merged, None)
+        while nextitem is not None:
+            fieldname, btext, _, postings = nextitem
+            nextitem = next(merged, None)
+            lastsource = (nextitem is None or nextitem[0] != fieldname
+                          or nextitem[1] != btext)
+
+            if fieldname != lastfn:
+                if lasttext is not None and self._pendingterm is None:
+                    self.finish_term()
+                if lastfn is not None:
+                    self.finish_field()
+                self.start_field(fieldname, schema[fieldname])
+                lastfn = fieldname
+                lasttext = None
+            if btext != lasttext:
+                if lasttext is not None and self._pendingterm is None:
+                    self.finish_term()
+                self._pendingterm = btext
+                lasttext = btext
+
+            if isinstance(postings, list):
+                self._start_pending_term()
+                for docnum, weight, value in postings:
+                    self.add(docnum, weight, value, dfl(docnum, fieldname))
+            else:
+                self._add_segment_postings(fieldname, postings, dfl,
+                                           lastsource)
+
+        if lasttext is not None and self._pendingterm is None:
+            self.finish_term()
+        if lastfn is not None:
+            self.finish_field()
+
+    def _start_pending_term(self):
+        if self._pendingterm is not None:
+            self.start_term(self._pendingterm)
+            self._pendingterm = None
+
+    def _add_segment_postings(self, fieldname, source, dfl, lastsource):
+        # Adds the postings of a term in a segment being merged
+        terms, terminfo, startdoc, docmap = source
+        m = terms._codec.postings_reader(terms._postfile, terminfo,
+                                         self._format)
+        copy_block = None
+        if isinstance(m, W3BinaryLeafMatcher):
+            copy_block = getattr(self._postwriter, "copy_block", None)
+
+        while m.is_active():
+            blockpos = None
+            if copy_block:
+                minid = m.block_min_id()
+                maxid = m.block_max_id()
+                buffered = self._pendingterm is None and len(self._postwriter)
+                if m._lastblock and (buffered or not lastsource):
+                    # The last block of a term in a segment is usually not
+                    # full, so unless it ends the new posting list, its
+                    # postings are buffered to fill a block with the postings
+                    # that follow instead of leaving a small block behind
+                    offset = None
+                elif docmap is None:
+                    offset = startdoc
+                elif (minid in docmap and maxid in docmap
+                      and docmap[maxid] - docmap[minid] == maxid - minid):
+                    # None of the block's documents were deleted, so they're
+                    # all renumbered by the same offset
+                    offset = docmap[minid] - minid
+                else:
+                    offset = None
+
+                if offset is not None:
+                    self._start_pending_term()
+                    copy_block(m, offset)
+                    m._next_block()
+                    continue
+                blockpos = m._blockpos
+
+            # Otherwise add the postings (of this block, if the matcher has
+            # blocks) one at a time, leaving out deleted documents
+            while m.is_active() and (blockpos is None
+                                     or m._blockpos == blockpos):
+                docnum = m.id()
+                if docmap is None:
+                    newdoc = startdoc + docnum
+                elif docnum in docmap:
+                    newdoc = docmap[docnum]
+                else:
+                    m.next()
+                    continue
+                value = m.value()
+                if value is None:
+                    value = emptybytes
+                self._start_pending_term()
+                self.add(newdoc, m.weight(), value, dfl(newdoc, fieldname))
+                m.next()
+
     def close(self):
+        if self._bloombits:
+            blooms = self._tindex.extras["blooms"] = {}
+            for fieldname, (h1s, h2s) in iteritems(self._termhashes):
+                bf = BloomFilter.from_hashes(h1s, h2s, self._bloombits)
+                blooms[fieldname] = bf.to_bytes()
         self._tindex.close()
         self._postfile.close()
         self.is_closed = True
 
 
+def _grouped_postings(items, srcnum):
+    # Groups a sorted stream of (fieldname, btext, docnum, weight, value)
+    # postings by term, for merging with the terms of other sources
+    lastkey = None
+    postings = None
+    for fieldname, btext, docnum, weight, value in items:
+        # Items with docnum == -1 are spelling words, not postings
+        if docnum == -1:
+            continue
+        if (fieldname, btext) != lastkey:
+            if lastkey is not None:
+                yield (lastkey[0], lastkey[1], srcnum, postings)
+            lastkey = (fieldname, btext)
+            postings = []
+        postings.append((docnum, weight, value))
+    if lastkey is not None:
+        yield (lastkey[0], lastkey[1], srcnum, postings)
+
+
+def _segment_terms(schema, terms, srcnum, startdoc, docmap):
+    # Yields the terms of a segment being merged in the same (fieldname,
+    # btext) order as _grouped_postings(). The term dictionary is ordered by
+    # field number, so the fields are read one at a time by name
+    for fieldname in sorted(terms.indexed_field_names()):
+        if fieldname not in schema:
+            continue
+        for (fname, btext), terminfo in terms.items_from(fieldname,
+                                                         emptybytes):
+            if fname != fieldname:
+                break
+            yield (fieldname, btext, srcnum,
+                   (terms, terminfo, startdoc, docmap))
+
+
 # Reader objects
 
 class W3PerDocReader(base.PerDocumentReader):
@@ -549,7 +848,7 @@ class W3FieldCursor(base.FieldCursor):
         if self._pos is None:
             return None
 
-        databytes = self._tindex.dbfile.get(self._datapos, self._datalen)
+        databytes = self._tindex.dbfile.get_view(self._datapos, self._datalen)
         return W3TermInfo.from_bytes(databytes)
 
     def is_valid(self):
@@ -557,17 +856,27 @@ class W3FieldCursor(base.FieldCursor):
 
 
 class W3TermsReader(base.TermsReader):
-    def __init__(self, codec, dbfile, length, postfile):
+    def __init__(self, codec, dbfile, length, postfile, segid=None):
         self._codec = codec
         self._dbfile = dbfile
-        self._tindex = filetables.OrderedHashReader(dbfile, length)
+        self._tindex = self._terms_index_reader(dbfile, length)
         self._fieldmap = self._tindex.extras["fieldmap"]
         self._postfile = postfile
+        # Segments written before filters existed have none, so every term
+        # is looked up in the dictionary
+        self._blooms = dict((fieldname, BloomFilter.from_bytes(bs))
+                            for fieldname, bs
+                            in iteritems(self._tindex.extras.get("blooms", {})))
+        # Identifies the segment's posting blocks in the shared block cache
+        self._segid = segid
 
         self._fieldunmap = [None] * len(self._fieldmap)
         for fieldname, num in iteritems(self._fieldmap):
             self._fieldunmap[num] = fieldname
 
+    def _terms_index_reader(self, dbfile, length):
+        return filetables.OrderedHashReader(dbfile, length)
+
     def _keycoder(self, fieldname, tbytes):
         assert isinstance(tbytes, bytes_type), "tbytes=%r" % tbytes
         fnum = self._fieldmap.get(fieldname, 65535)
@@ -577,10 +886,20 @@ class W3TermsReader(base.TermsReader):
         fieldid = unpack_ushort(keybytes[:_SHORT_SIZE])[0]
         return self._fieldunmap[fieldid], keybytes[_SHORT_SIZE:]
 
+    def _may_contain(self, fieldname, tbytes):
+        # False if the field's Bloom filter rules the term out, so the lookup
+        # in the term dictionary can be skipped
+        bf = self._blooms.get(fieldname)
+        return bf is None or tbytes in bf
+
     def _range_for_key(self, fieldname, tbytes):
+        if not self._may_contain(fieldname, tbytes):
+            raise KeyError((fieldname, tbytes))
         return self._tindex.range_for_key(self._keycoder(fieldname, tbytes))
 
     def __contains__(self, term):
+        if not self._may_contain(*term):
+            return False
         return self._keycoder(*term) in self._tindex
 
     def indexed_field_names(self):
@@ -602,6 +921,15 @@ class W3TermsReader(base.TermsReader):
         return (keydecoder(keybytes) for keybytes
                 in self._tindex.keys_from(prefixbytes))
 
+    def expand_prefix(self, fieldname, prefix):
+        # The terms of a field share the field number prefix, so just strip it
+        # off the keys instead of decoding each one
+        prefixbytes = self._keycoder(fieldname, prefix)
+        for keybytes in self._tindex.keys_from(prefixbytes):
+            if not keybytes.startswith(prefixbytes):
+                return
+            yield keybytes[_SHORT_SIZE:]
+
     def items(self):
         tidecoder = W3TermInfo.from_bytes
         keydecoder = self._keydecoder
@@ -616,11 +944,12 @@ class W3TermsReader(base.TermsReader):
                 for keybytes, valbytes in self._tindex.items_from(prefixbytes))
 
     def term_info(self, fieldname, tbytes):
-        key = self._keycoder(fieldname, tbytes)
         try:
-            return W3TermInfo.from_bytes(self._tindex[key])
+            datapos, datalen = self._range_for_key(fieldname, tbytes)
         except KeyError:
             raise TermNotFound("No term %s:%r" % (fieldname, tbytes))
+        # The term info is unpacked straight from a view of the terms file
+        return W3TermInfo.from_bytes(self._dbfile.get_view(datapos, datalen))
 
     def frequency(self, fieldname, tbytes):
         datapos = self._range_for_key(fieldname, tbytes)[0]
@@ -633,7 +962,8 @@ class W3TermsReader(base.TermsReader):
     def matcher(self, fieldname, tbytes, format_, scorer=None):
         terminfo = self.term_info(fieldname, tbytes)
         m = self._codec.postings_reader(self._postfile, terminfo, format_,
-                                        term=(fieldname, tbytes), scorer=scorer)
+                                        term=(fieldname, tbytes), scorer=scorer,
+                                        segid=self._segid)
         return m
 
     def close(self):
@@ -641,6 +971,87 @@ class W3TermsReader(base.TermsReader):
         self._postfile.close()
 
 
+# Front-coded term dictionary
+
+class W3FrontCodedFieldWriter(W3FieldWriter):
+    """Writes the term dictionary as a
+    :class:`~whoosh.filedb.filetables.FrontCodedWriter` file. The keys are
+    the same field number + term bytes keys as :class:`W3FieldWriter`, so
+    terms sort by field and then by term, and the terms of a field are
+    contiguous.
+    """
+
+    def _terms_index_writer(self, dbfile):
+        return filetables.FrontCodedWriter(dbfile, magic=b("W3Fc"))
+
+
+class W3FrontCodedTermsReader(W3TermsReader):
+    def _terms_index_reader(self, dbfile, length):
+        return filetables.FrontCodedReader(dbfile, length, magic=b("W3Fc"))
+
+    def cursor(self, fieldname, fieldobj):
+        return W3FrontCodedCursor(self._tindex, fieldname, self._keycoder,
+                                  self._keydecoder, fieldobj)
+
+
+class W3FrontCodedCursor(base.FieldCursor):
+    # Front-coded keys can only be decoded in order from the start of a block,
+    # so instead of remembering a file position this cursor keeps the
+    # generator of key ranges it is reading from
+
+    def __init__(self, tindex, fieldname, keycoder, keydecoder, fieldobj):
+        self._tindex = tindex
+        self._fieldname = fieldname
+        self._keycoder = keycoder
+        self._keydecoder = keydecoder
+        self._fieldobj = fieldobj
+
+        self._prefix = keycoder(fieldname, emptybytes)
+        self._ranges = None
+        self._text = None
+        self._datapos = None
+        self._datalen = None
+        self.first()
+
+    def first(self):
+        self._ranges = self._tindex.ranges_from(self._prefix)
+        return self.next()
+
+    def find(self, term):
+        if not isinstance(term, bytes_type):
+            term = self._fieldobj.to_bytes(term)
+        key = self._keycoder(self._fieldname, term)
+        self._ranges = self._tindex.ranges_from(key)
+        return self.next()
+
+    def next(self):
+        if self._ranges is not None:
+            for keybytes, datapos, datalen in self._ranges:
+                fname, text = self._keydecoder(keybytes)
+                if fname == self._fieldname:
+                    self._text = self._fieldobj.from_bytes(text)
+                    self._datapos = datapos
+                    self._datalen = datalen
+                    return self._text
+                break
+
+        self._ranges = self._text = self._datapos = self._datalen = None
+        return None
+
+    def text(self):
+        return self._text
+
+    def term_info(self):
+        if self._ranges is None:
+            return None
+
+        databytes = self._tindex.dbfile.get_view(self._datapos, self._datalen)
+        return W3TermInfo.from_bytes(databytes)
+
+    def is_valid(self):
+        return self._ranges is not None
+
+
 # Postings
 
 class W3PostingsWriter(base.PostingsWriter):
@@ -870,8 +1281,11 @@ class W3LeafMatcher(LeafMatcher):
     :class:`whoosh.matching.Matcher` interface.
     """
 
+    # The header tag expected at the start of the postings
+    magic = WHOOSH3_HEADER_MAGIC
+
     def __init__(self, postfile, startoffset, length, format_, term=None,
-                 byteids=None, scorer=None):
+                 byteids=None, scorer=None, segid=None):
         self._postfile = postfile
         self._startoffset = startoffset
         self._length = length
@@ -879,6 +1293,9 @@ class W3LeafMatcher(LeafMatcher):
         self._term = term
         self._byteids = byteids
         self.scorer = scorer
+        # If we know the segment and term, decoded blocks are kept in the
+        # shared block cache
+        self._segid = segid if term is not None else None
 
         self._fixedsize = self.format.fixed_value_size()
         # Read the header tag at the start of the postings
@@ -890,13 +1307,12 @@ class W3LeafMatcher(LeafMatcher):
         # Seek to the start of the postings and check the header tag
         postfile = self._postfile
 
-        postfile.seek(self._startoffset)
-        magic = postfile.read(4)
-        if magic != WHOOSH3_HEADER_MAGIC:
-            raise Exception("Block tag error %r" % magic)
+        magic = postfile.get_view(self._startoffset, 4)
+        if magic != self.magic:
+            raise Exception("Block tag error %r" % bytes_type(magic))
 
         # Remember the base offset (start of postings, after the header)
-        self._baseoffset = postfile.tell()
+        self._baseoffset = self._startoffset + 4
 
     def reset(self):
         # Reset block stats
@@ -925,6 +1341,7 @@ class W3LeafMatcher(LeafMatcher):
         self._values = None
         # Reset pointer into the block
         self._i = 0
+        self._blockpos = position
 
         # Seek to the start of the block
         postfile.seek(position)
@@ -999,6 +1416,25 @@ class W3LeafMatcher(LeafMatcher):
 
         return self._values[self._i]
 
+    def all_ids(self):
+        # Go through the blocks only loading the IDs, so counting and deleting
+        # don't pay to decode weights and values they never look at
+        while self.is_active():
+            if self._ids is None:
+                self._read_ids()
+            for docid in self._ids[self._i:]:
+                yield docid
+            self._next_block()
+
+    def id_count(self):
+        # The number of postings is in each block's header, so the IDs don't
+        # need to be decoded at all
+        count = 0
+        while self.is_active():
+            count += self._blocklength - self._i
+            self._next_block()
+        return count
+
     def next(self):
         # Move to the next posting
 
@@ -1067,7 +1503,7 @@ class W3LeafMatcher(LeafMatcher):
         # Load block data tuple from disk
 
         datalen = self._nextoffset - self._dataoffset
-        b = self._postfile.get(self._dataoffset, datalen)
+        b = self._postfile.get_view(self._dataoffset, datalen)
 
         # Decompress the pickled data if necessary
         if self._compression:
@@ -1076,7 +1512,34 @@ class W3LeafMatcher(LeafMatcher):
         # Unpickle the data tuple and save it in an attribute
         self._data = loads(b)
 
+    def _cached(self, part, decode):
+        # Returns the given part ("i", "w" or "v") of the current block from
+        # the shared block cache, calling decode() to make it on a miss. The
+        # cached objects are shared between matchers, so they must never be
+        # modified
+
+        segid = self._segid
+        if segid is None or not block_cache.maxbytes:
+            return decode()
+
+        fieldname, tbytes = self._term
+        key = (segid, fieldname, tbytes, self._blockpos, part)
+        value = block_cache.get(key)
+        if value is None:
+            value = decode()
+            block_cache.put(key, value, _decoded_size(value))
+        return value
+
     def _read_ids(self):
+        self._ids = self._cached("i", self._decode_ids)
+
+    def _read_weights(self):
+        self._weights = self._cached("w", self._decode_weights)
+
+    def _read_values(self):
+        self._values = self._cached("v", self._decode_values)
+
+    def _decode_ids(self):
         # If we haven't loaded the data from disk yet, load it now
         if self._data is None:
             self._read_data()
@@ -1086,9 +1549,9 @@ class W3LeafMatcher(LeafMatcher):
         if not self._byteids:
             ids = tuple(delta_decode(ids))
 
-        self._ids = ids
+        return ids
 
-    def _read_weights(self):
+    def _decode_weights(self):
         # If we haven't loaded the data from disk yet, load it now
         if self._data is None:
             self._read_data()
@@ -1097,13 +1560,13 @@ class W3LeafMatcher(LeafMatcher):
         # De-minify the weights
         postcount = self._blocklength
         if weights is None:
-            self._weights = array("f", (1.0 for _ in xrange(postcount)))
+            return array("f", (1.0 for _ in xrange(postcount)))
         elif isinstance(weights, float):
-            self._weights = array("f", (weights for _ in xrange(postcount)))
+            return array("f", (weights for _ in xrange(postcount)))
         else:
-            self._weights = weights
+            return weights
 
-    def _read_values(self):
+    def _decode_values(self):
         # If we haven't loaded the data from disk yet, load it now
         if self._data is None:
             self._read_data()
@@ -1112,13 +1575,348 @@ class W3LeafMatcher(LeafMatcher):
         fixedsize = self._fixedsize
         vs = self._data[2]
         if fixedsize is None or fixedsize < 0:
-            self._values = vs
+            return vs
         elif fixedsize is 0:
-            self._values = (None,) * self._blocklength
+            return (None,) * self._blocklength
         else:
             assert isinstance(vs, bytes_type)
-            self._values = tuple(vs[i:i + fixedsize]
-                                 for i in xrange(0, len(vs), fixedsize))
+            return tuple(vs[i:i + fixedsize]
+                         for i in xrange(0, len(vs), fixedsize))
+
+
+# Binary postings
+
+# Fixed-width header at the start of each W3BinaryCodec block:
+#
+# I   | Number of postings in block
+# I   | First ID in block
+# I   | Last ID in block
+# d   | Maximum weight in block
+# B   | Compression level of the values section
+# B   | Minimum length byte
+# B   | Maximum length byte
+# B   | Item size of the ID gaps array, 0 if the gaps are PFor packed
+# B   | Weights kind (see below)
+# B   | Item size of the value lengths array (0 for fixed size values)
+#
+# The header is followed by the ID gaps, the weights and the values sections.
+# The sizes of the first two follow from the header, the values section takes
+# the rest of the block.
+_BLOCK_HEADER = struct.Struct("<IIIdBBBBBB")
+
+# Weights kinds: every weight is 1.0, every weight is the same single float,
+# or an array of floats
+_WEIGHTS_ONE = 0
+_WEIGHTS_SAME = 1
+_WEIGHTS_ARRAY = 2
+
+_TYPECODES = {1: "B", 2: "H", 4: "I"}
+
+
+def _pack_array(typecode, items):
+    arry = array(typecode, items)
+    if not IS_LITTLE:
+        arry.byteswap()
+    return array_tobytes(arry)
+
+
+def _unpack_array(typecode, bs):
+    arry = array(typecode)
+    array_frombytes(arry, bs)
+    if not IS_LITTLE:
+        arry.byteswap()
+    return arry
+
+
+def _item_size(maxval):
+    # Returns the smallest array item size that can hold the given value
+    if maxval < 1 << 8:
+        return 1
+    elif maxval < 1 << 16:
+        return 2
+    else:
+        return 4
+
+
+class W3BinaryPostingsWriter(W3PostingsWriter):
+    """Writes posting lists in the :class:`W3BinaryCodec` block format. Block
+    statistics and term info are handled by :class:`W3PostingsWriter`.
+    """
+
+    def __init__(self, postfile, blocklimit, compression=3, inlinelimit=1,
+                 pfor=False):
+        W3PostingsWriter.__init__(self, postfile, blocklimit,
+                                  compression=compression,
+                                  inlinelimit=inlinelimit)
+        self._pfor = pfor
+        # (header, body) of a block copied by copy_block() that hasn't been
+        # written yet
+        self._copied = None
+
+    def copy_block(self, matcher, offset):
+        """Adds the current block of a :class:`W3BinaryLeafMatcher` to the
+        posting list as it is, only adding ``offset`` to the IDs in the block
+        header (the rest of the IDs are stored as gaps). This is used to merge
+        segments without decoding and re-encoding their postings.
+        """
+
+        # Write out any buffered postings first to keep the IDs in order
+        if self._ids:
+            self._write_block()
+        self._write_copied()
+        if not self._blockcount:
+            self._postfile.write(WHOOSH3_BINARY_MAGIC)
+
+        postfile = matcher._postfile
+        headerpos = matcher._blockpos + _INT_SIZE
+        header = list(_BLOCK_HEADER.unpack(
+            postfile.get_view(headerpos, _BLOCK_HEADER.size)))
+        header[1] += offset
+        header[2] += offset
+        bodypos = headerpos + _BLOCK_HEADER.size
+        body = bytes_type(postfile.get_view(bodypos,
+                                            matcher._nextoffset - bodypos))
+
+        (count, minid, maxid, maxweight, _, mnlen, mxlen) = header[:7]
+        weight = sum(matcher._decode_weights())
+        self._terminfo.add_block_info(count, weight, byte_to_length(mnlen),
+                                      byte_to_length(mxlen), maxweight, minid,
+                                      maxid)
+
+        # The last block of a posting list has a negative length, so the
+        # block is only written when we know whether anything follows it
+        self._copied = (_BLOCK_HEADER.pack(*header), body)
+        self._blockcount += 1
+
+    def _write_copied(self, last=False):
+        if self._copied is None:
+            return
+        header, body = self._copied
+        self._copied = None
+
+        blocklength = len(header) + len(body)
+        if last:
+            blocklength *= -1
+        postfile = self._postfile
+        postfile.write_int(blocklength)
+        postfile.write(header)
+        postfile.write(body)
+
+    def finish_postings(self):
+        # A copied block is the last block unless postings were added after it
+        if not self._ids:
+            self._write_copied(last=True)
+        return W3PostingsWriter.finish_postings(self)
+
+    def _write_block(self, last=False):
+        # If this is the first block, write a small header first
+        if not self._blockcount:
+            self._postfile.write(WHOOSH3_BINARY_MAGIC)
+        self._write_copied()
+
+        self._terminfo.add_block(self)
+
+        # IDs are stored as gaps from the previous ID in the smallest array
+        # type that holds the largest gap; the first ID is in the header
+        ids = self._ids
+        gaps = [ids[i] - ids[i - 1] for i in xrange(1, len(ids))]
+        idsize = _item_size(max(gaps)) if gaps else 1
+        idbytes = _pack_array(_TYPECODES[idsize], gaps)
+        if self._pfor and gaps:
+            packed = pfor_encode(gaps)
+            if len(packed) < len(idbytes):
+                idsize = 0
+                idbytes = packed
+
+        weights = self._weights
+        if all(w == 1.0 for w in weights):
+            wkind = _WEIGHTS_ONE
+            weightbytes = emptybytes
+        elif all(w == weights[0] for w in weights):
+            wkind = _WEIGHTS_SAME
+            weightbytes = _pack_array("f", weights[:1])
+        else:
+            wkind = _WEIGHTS_ARRAY
+            weightbytes = _pack_array("f", weights)
+
+        # Variable size values are preceded by an array of their lengths
+        fixedsize = self._format.fixed_value_size()
+        values = self._values
+        lensize = 0
+        if fixedsize is None or fixedsize < 0:
+            lengths = [len(v) for v in values]
+            lensize = _item_size(max(lengths)) if lengths else 1
+            valuebytes = (_pack_array(_TYPECODES[lensize], lengths)
+                          + emptybytes.join(values))
+        elif fixedsize == 0:
+            valuebytes = emptybytes
+        else:
+            valuebytes = emptybytes.join(values)
+
+        # Don't bother compressing tiny value sections
+        comp = self._compression if len(valuebytes) >= 20 else 0
+        if comp:
+            valuebytes = zlib.compress(valuebytes, comp)
+
+        header = _BLOCK_HEADER.pack(len(ids), ids[0], ids[-1], self._maxweight,
+                                    comp, length_to_byte(self._minlength),
+                                    length_to_byte(self._maxlength),
+                                    idsize, wkind, lensize)
+
+        # Write block length, negative if this is the last block
+        postfile = self._postfile
+        blocklength = (len(header) + len(idbytes) + len(weightbytes)
+                       + len(valuebytes))
+        if last:
+            blocklength *= -1
+        postfile.write_int(blocklength)
+        postfile.write(header)
+        postfile.write(idbytes)
+        postfile.write(weightbytes)
+        postfile.write(valuebytes)
+
+        self._blockcount += 1
+        self._new_block()
+
+
+class W3BinaryLeafMatcher(W3LeafMatcher):
+    """Reads postings written by :class:`W3BinaryPostingsWriter`. The IDs,
+    weights and values of a block are each decoded from their own section the
+    first time they are needed.
+    """
+
+    magic = WHOOSH3_BINARY_MAGIC
+
+    def _goto(self, position):
+        postfile = self._postfile
+
+        self._ids = None
+        self._weights = None
+        self._values = None
+        self._i = 0
+        self._blockpos = position
+
+        length = postfile.get_int(position)
+        if length < 0:
+            self._lastblock = True
+            length *= -1
+        self._nextoffset = position + _INT_SIZE + length
+
+        # The header and sections are read through views of the postings file
+        # so a memory-mapped segment doesn't copy them out
+        headerpos = position + _INT_SIZE
+        (count, self._minid, self._maxid, self._maxweight, self._compression,
+         mnlen, mxlen, idsize, self._weightkind, self._lensize
+         ) = _BLOCK_HEADER.unpack(postfile.get_view(headerpos,
+                                                    _BLOCK_HEADER.size))
+        self._blocklength = count
+        self._minlength = byte_to_length(mnlen)
+        self._maxlength = byte_to_length(mxlen)
+
+        # Work out where each section of the block starts
+        self._idsize = idsize
+        self._idsoffset = headerpos + _BLOCK_HEADER.size
+        if idsize:
+            self._weightsoffset = self._idsoffset + (count - 1) * idsize
+        else:
+            self._weightsoffset = self._idsoffset + pfor_length(
+                postfile.get_view(self._idsoffset, 3), count - 1)
+        if self._weightkind == _WEIGHTS_ARRAY:
+            self._valuesoffset = self._weightsoffset + count * _FLOAT_SIZE
+        elif self._weightkind == _WEIGHTS_SAME:
+            self._valuesoffset = self._weightsoffset + _FLOAT_SIZE
+        else:
+            self._valuesoffset = self._weightsoffset
+
+    def block_min_id(self):
+        return self._minid
+
+    def _decode_ids(self):
+        idbytes = self._postfile.get_view(self._idsoffset,
+                                          self._weightsoffset - self._idsoffset)
+        if not self._idsize:
+            return pfor_decode(idbytes, self._blocklength - 1,
+                               base=self._minid)
+
+        gaps = _unpack_array(_TYPECODES[self._idsize], idbytes)
+        return array("I", accumulate(chain((self._minid,), gaps)))
+
+    def _decode_weights(self):
+        postcount = self._blocklength
+        kind = self._weightkind
+        if kind == _WEIGHTS_ONE:
+            return array("f", (1.0 for _ in xrange(postcount)))
+
+        weights = _unpack_array("f", self._postfile.get_view(
+            self._weightsoffset, self._valuesoffset - self._weightsoffset))
+        if kind == _WEIGHTS_SAME:
+            weights = weights * postcount
+        return weights
+
+    def _read_values(self):
+        # Uncompressed values are only views of the postings file, which are
+        # cheap to make and mustn't outlive it, so only decompressed values go
+        # in the block cache
+        if self._compression:
+            self._values = self._cached("v", self._decode_values)
+        else:
+            self._values = self._decode_values()
+
+    def _decode_values(self):
+        fixedsize = self._fixedsize
+        if fixedsize == 0:
+            return (None,) * self._blocklength
+
+        vs = self._postfile.get_view(self._valuesoffset,
+                                     self._nextoffset - self._valuesoffset)
+        if self._compression:
+            vs = zlib.decompress(vs)
+
+        if fixedsize is None or fixedsize < 0:
+            # Only work out where each value is; a value (for example the
+            # positions of a term in a document) is copied out the first time
+            # its posting is looked at, so a phrase query only pays for the
+            # documents that survive the ID intersection
+            lensize = self._lensize
+            base = self._blocklength * lensize
+            lengths = _unpack_array(_TYPECODES[lensize], vs[:base])
+            offsets = list(accumulate(chain((base,), lengths)))
+            return _BlockValues(vs, offsets)
+        else:
+            vs = bytes_type(vs)
+            return tuple(vs[i:i + fixedsize]
+                         for i in xrange(0, len(vs), fixedsize))
+
+
+class _BlockValues(object):
+    # Sequence of the variable size values in a block, sliced out of the
+    # (possibly memory-mapped) value section on demand
+
+    __slots__ = ("_buf", "_offsets")
+
+    def __init__(self, buf, offsets):
+        self._buf = buf
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        offsets = self._offsets
+        return bytes_type(self._buf[offsets[i]:offsets[i + 1]])
+
+
+def _decoded_size(value):
+    # Approximate number of bytes a decoded block part takes up, for the
+    # block cache's budget
+    if isinstance(value, array):
+        return len(value) * value.itemsize
+    elif isinstance(value, bytes_type):
+        return len(value)
+    elif isinstance(value, _BlockValues):
+        return len(value._buf) + len(value._offsets) * 8
+    # A tuple or list; count a pointer for each item plus any byte strings
+    return sum(len(v) + 8 if isinstance(v, bytes_type) else 8 for v in value)
 
 
 # Term info implementation
@@ -1156,6 +1954,24 @@ class W3TermInfo(TermInfo):
             self._minid = block.min_id()
         self._maxid = block.max_id()
 
+    def add_block_info(self, count, weight, minlength, maxlength, maxweight,
+                       minid, maxid):
+        # Like add_block() for a block that was copied without decoding it,
+        # using the statistics from its header
+        self._weight += weight
+        self._df += count
+
+        if self._minlength is None:
+            self._minlength = minlength
+        else:
+            self._minlength = min(self._minlength, minlength)
+
+        self._maxlength = max(self._maxlength, maxlength)
+        self._maxweight = max(self._maxweight, maxweight)
+        if self._minid is None:
+            self._minid = minid
+        self._maxid = maxid
+
     def set_extent(self, offset, length):
         self._offset = offset
         self._length = length
@@ -436,6 +436,13 @@ class TopCollector(ScoredCollector):
         self.usequality = usequality
         self.total = 0
 
+    def prepare(self, top_searcher, q, context):
+        # Let the queries know only the top N documents are needed, so they
+        # can use matchers that skip the others
+        if self.usequality:
+            context = context.set(limit=self.limit, top_query=q)
+        ScoredCollector.prepare(self, top_searcher, q, context)
+
     def _use_block_quality(self):
         return (self.usequality
                 and not self.top_searcher.weighting.use_final
@@ -455,7 +462,7 @@ class TopCollector(ScoredCollector):
         if self.computes_count():
             return self.total
         else:
-            return ilen(self.all_ids())
+            return self.top_searcher.count(self.q)
 
     # ScoredCollector.collect calls this
     def _collect(self, global_docnum, score):
@@ -609,7 +609,7 @@ class RefBytesColumn(Column):
 
         def __getitem__(self, docnum):
             pos = self._basepos + docnum * self._itemsize
-            ref = self._unpack(self._dbfile.get(pos, self._itemsize))[0]
+            ref = self._unpack(self._dbfile.get_view(pos, self._itemsize))[0]
             return self._uniques[ref]
 
         def __iter__(self):
@@ -697,7 +697,12 @@ class NumericColumn(FixedBytesColumn):
             return "<Numeric.Reader>"
 
         def __getitem__(self, docnum):
-            s = FixedBytesColumn.Reader.__getitem__(self, docnum)
+            if docnum >= self._count:
+                s = self._defaultbytes
+            else:
+                # Unpack straight from a view to avoid copying the bytes
+                pos = self._basepos + self._fixedlen * docnum
+                s = self._dbfile.get_view(pos, self._fixedlen)
             return self._unpack(s)[0]
 
         def sort_key(self, docnum):
@@ -775,7 +780,7 @@ class BitColumn(Column):
 
             compressed = dbfile.get_byte(basepos + (length - 1))
             if compressed:
-                bbytes = zlib.decompress(dbfile.get(basepos, length - 1))
+                bbytes = zlib.decompress(dbfile.get_view(basepos, length - 1))
                 bitset = BitSet.from_bytes(bbytes)
             else:
                 dbfile.seek(basepos)
@@ -880,8 +885,9 @@ class CompressedBytesColumn(Column):
 class CompressedBlockColumn(Column):
     """An experimental column type that compresses and decompresses blocks of
     values at a time. This can lead to high compression and decent performance
-    for columns with lots of very short values, but random access times are
-    usually terrible.
+    for columns with lots of very short values or a few long ones. Random
+    access has to decompress a whole block, so the reader keeps the last
+    decompressed block around for reading neighbouring documents.
     """
 
     def __init__(self, level=3, blocksize=32, module="zlib"):
@@ -917,12 +923,13 @@ class CompressedBlockColumn(Column):
 
         def _reset(self):
             self._startdoc = None
-            self._block = emptybytes
+            self._parts = []
+            self._size = 0
             self._lengths = []
 
         def _emit(self):
             dbfile = self._dbfile
-            block = self._compress(self._block, self._level)
+            block = self._compress(emptybytes.join(self._parts), self._level)
             header = (self._startdoc, self._lastdoc, len(block),
                       tuple(self._lengths))
             dbfile.write_pickle(header)
@@ -934,8 +941,11 @@ class CompressedBlockColumn(Column):
             self._lengths.append((docnum, len(v)))
             self._lastdoc = docnum
 
-            self._block += v
-            if len(self._block) >= self._blocksize:
+            # Collect the values in a list and join them when the block is
+            # emitted, instead of growing a bytes object one value at a time
+            self._parts.append(v)
+            self._size += len(v)
+            if self._size >= self._blocksize:
                 self._emit()
                 self._reset()
 
@@ -949,68 +959,72 @@ class CompressedBlockColumn(Column):
             ColumnReader.__init__(self, dbfile, basepos, length, doccount)
             self._decompress = __import__(module).decompress
 
+            # Block positions are kept relative to basepos
             self._blocks = []
+            self._starts = []
             dbfile.seek(basepos)
             pos = 0
             while pos < length:
                 startdoc, enddoc, blocklen, lengths = dbfile.read_pickle()
-                here = dbfile.tell()
+                here = dbfile.tell() - basepos
                 self._blocks.append((startdoc, enddoc, here, blocklen,
                                      lengths))
-                dbfile.seek(blocklen, 1)
+                self._starts.append(startdoc)
                 pos = here + blocklen
+                dbfile.seek(basepos + pos)
+
+            # The most recently decompressed block, as (blocknum, values), so
+            # reading neighbouring documents doesn't decompress it again
+            self._cached = None
 
         def __repr__(self):
             return "<CompressedBlock.Reader>"
 
         def _find_block(self, docnum):
-            # TODO: use binary search instead of linear
-            for i, b in enumerate(self._blocks):
-                if docnum < b[0]:
-                    return None
-                elif docnum <= b[1]:
-                    return i
-            return None
+            i = bisect_right(self._starts, docnum) - 1
+            if i < 0 or docnum > self._blocks[i][1]:
+                return None
+            return i
 
         def _get_block(self, blocknum):
+            cached = self._cached
+            if cached is not None and cached[0] == blocknum:
+                return cached[1]
+
             block = self._blocks[blocknum]
             pos = block[2]
             blocklen = block[3]
             lengths = block[4]
 
-            data = self._decompress(self._dbfile.get(self._basepos + pos,
-                                                     blocklen))
+            data = self._decompress(self._dbfile.get_view(self._basepos + pos,
+                                                          blocklen))
             values = {}
             base = 0
             for docnum, vlen in lengths:
                 values[docnum] = data[base:base + vlen]
                 base += vlen
+            self._cached = (blocknum, values)
             return values
 
         def __getitem__(self, docnum):
             i = self._find_block(docnum)
             if i is None:
                 return emptybytes
-            return self._get_block(i)[docnum]
+            return self._get_block(i).get(docnum, emptybytes)
 
         def __iter__(self):
             last = -1
             for i, block in enumerate(self._blocks):
                 startdoc = block[0]
                 enddoc = block[1]
-                if startdoc > (last + 1):
-                    for _ in xrange(startdoc - last):
-                        yield emptybytes
+                for _ in xrange(startdoc - last - 1):
+                    yield emptybytes
                 values = self._get_block(i)
                 for docnum in xrange(startdoc, enddoc + 1):
-                    if docnum in values:
-                        yield values[docnum]
-                    else:
-                        yield emptybytes
+                    yield values.get(docnum, emptybytes)
                 last = enddoc
-            if enddoc < self._doccount - 1:
-                for _ in xrange(self._doccount - enddoc):
-                    yield emptybytes
+            for _ in xrange(self._doccount - last - 1):
+                yield emptybytes
 
 
 class StructColumn(FixedBytesColumn):
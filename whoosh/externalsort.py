@@ -31,7 +31,7 @@ This module implements a general external merge sort for Python objects.
 
 from __future__ import with_statement
 
-import os, tempfile
+import os, struct, tempfile
 from heapq import heapify, heappop, heapreplace
 
 from WhooshSearch.whoosh.compat import dump, load
@@ -225,6 +225,123 @@ class SortingPool(object):
         return self._merge_runs(runs)
 
 
+# Binary runs
+
+# A record of a binary run is a header holding the lengths of its key and its
+# payload, followed by the key bytes and the payload bytes
+_record_header = struct.Struct("<II")
+
+
+def write_records(f, records, buffersize=1024 * 1024):
+    """Writes ``(key, payload)`` pairs of byte strings to the file ``f`` as
+    length-prefixed binary records.
+
+    :param buffersize: the records are written in chunks of about this many
+        bytes.
+    """
+
+    pack = _record_header.pack
+    buf = bytearray()
+    for key, payload in records:
+        buf += pack(len(key), len(payload))
+        buf += key
+        buf += payload
+        if len(buf) >= buffersize:
+            f.write(buf)
+            buf = bytearray()
+    if buf:
+        f.write(buf)
+
+
+def read_records(f, windowsize=64 * 1024):
+    """Yields the ``(key, payload)`` pairs written to the file ``f`` by
+    :func:`write_records`.
+
+    :param windowsize: the file is read in windows of this many bytes.
+    """
+
+    unpack = _record_header.unpack_from
+    hsize = _record_header.size
+    buf = b""
+    pos = 0
+    while True:
+        window = f.read(windowsize)
+        if not window:
+            break
+        # Keep the partial record at the end of the last window
+        buf = buf[pos:] + window if pos < len(buf) else window
+        pos = 0
+        end = len(buf)
+        while pos + hsize <= end:
+            keylen, paylen = unpack(buf, pos)
+            keyend = pos + hsize + keylen
+            recend = keyend + paylen
+            if recend > end:
+                break
+            yield buf[pos + hsize:keyend], buf[keyend:recend]
+            pos = recend
+    if pos < len(buf):
+        raise EOFError("Truncated record at the end of the run")
+
+
+class BinarySortingPool(SortingPool):
+    """A :class:`SortingPool` for ``(key, payload)`` pairs of byte strings,
+    which are sorted by key.
+
+    Runs are written as length-prefixed binary records (see
+    :func:`write_records`) instead of marshalled objects, read back in
+    windows of ``windowsize`` bytes, and merged by comparing the raw keys, so
+    merging doesn't build or compare any object but the byte strings. To limit the number of runs open
+    at once during the final merge, whenever there are more than ``maxruns``
+    runs the newest half of them are merged into one run.
+    """
+
+    def __init__(self, maxsize=1000000, tempdir=None, prefix="",
+                 suffix=".run", maxruns=32, windowsize=64 * 1024):
+        """
+        :param maxruns: the maximum number of runs to keep before merging
+            some of them.
+        :param windowsize: the number of bytes of a run read at a time while
+            merging.
+        """
+
+        SortingPool.__init__(self, maxsize=maxsize, tempdir=tempdir,
+                             prefix=prefix, suffix=suffix)
+        if maxruns < 2:
+            raise ValueError("maxruns=%s must be >= 2" % maxruns)
+        self.maxruns = maxruns
+        self.windowsize = windowsize
+
+    def _read_records(self, path):
+        f = self._open_run(path)
+        try:
+            for record in read_records(f, self.windowsize):
+                yield record
+        finally:
+            f.close()
+            self._remove_run(path)
+
+    def _read_run(self, path):
+        return self._read_records(path)
+
+    def _merge_runs(self, paths):
+        return imerge([self._read_records(path) for path in paths])
+
+    def _write_run(self, f, items):
+        write_records(f, items)
+        f.close()
+
+    def _add_run(self, filename):
+        SortingPool._add_run(self, filename)
+        if len(self.runs) > self.maxruns:
+            # Intermediate merge pass
+            half = len(self.runs) // 2
+            self.reduce_to(len(self.runs) - half + 1, half)
+
+    def items(self, maxfiles=128):
+        return SortingPool.items(self, maxfiles=min(maxfiles, self.maxruns))
+
+
 def sort(items, maxsize=100000, tempdir=None, maxfiles=128):
     """Sorts the given items using an external merge sort.
 
@@ -27,18 +27,22 @@
 
 """This module defines writer and reader classes for a fast, immutable
 on-disk key-value database format. The current format is based heavily on
-D. J. Bernstein's CDB format (http://cr.yp.to/cdb.html).
+D. J. Bernstein's CDB format (http://cr.yp.to/cdb.html). There is also a
+compact front-coded format for files where the keys are sorted, such as term
+dictionaries.
 """
 
 import os, struct
+from array import array
 from binascii import crc32
-from bisect import bisect_left
+from bisect import bisect_left, bisect_right
 from hashlib import md5  # @UnresolvedImport
 
 from WhooshSearch.whoosh.compat import b, bytes_type
 from WhooshSearch.whoosh.compat import xrange
 from WhooshSearch.whoosh.util.numlists import GrowableArray
-from WhooshSearch.whoosh.system import _INT_SIZE, emptybytes
+from WhooshSearch.whoosh.system import _INT_SIZE, _LONG_SIZE, emptybytes
+from WhooshSearch.whoosh.util.varints import varint, decode_varint
 
 
 # Exceptions
@@ -315,7 +319,7 @@ class HashReader(object):
         if pos >= self.endofdata:
             return None
 
-        keylen, datalen = _lengths.unpack(dbfile.get(pos, lenssize))
+        keylen, datalen = _lengths.unpack(dbfile.get_view(pos, lenssize))
         keybytes = dbfile.get(pos + lenssize, keylen)
         datapos = pos + lenssize + keylen
         return keybytes, datapos, datalen
@@ -330,7 +334,7 @@ class HashReader(object):
         unpacklens = _lengths.unpack
 
         while pos < eod:
-            keylen, datalen = unpacklens(dbfile.get(pos, lenssize))
+            keylen, datalen = unpacklens(dbfile.get_view(pos, lenssize))
             keypos = pos + lenssize
             datapos = keypos + keylen
             yield (keypos, keylen, datapos, datalen)
@@ -408,7 +412,7 @@ class HashReader(object):
         slotpos = tablestart + (((keyhash >> 8) % numslots) * ptrsize)
         # Read slots looking for our key's hash value
         for _ in xrange(numslots):
-            slothash, itempos = unpackptr(dbfile.get(slotpos, ptrsize))
+            slothash, itempos = unpackptr(dbfile.get_view(slotpos, ptrsize))
             # If this slot is empty, we're done
             if not itempos:
                 return
@@ -417,11 +421,13 @@ class HashReader(object):
             # a match, so read the actual key and see if it's our key
             if slothash == keyhash:
                 # Read the key and value lengths
-                keylen, datalen = unpacklens(dbfile.get(itempos, lenssize))
+                keylen, datalen = unpacklens(dbfile.get_view(itempos,
+                                                               lenssize))
                 # Only bother reading the actual key if the lengths match
                 if keylen == len(key):
                     keystart = itempos + lenssize
-                    if key == dbfile.get(keystart, keylen):
+                    # Compare against a view so the key isn't copied
+                    if key == dbfile.get_view(keystart, keylen):
                         # The keys match, so yield (datapos, datalen)
                         yield (keystart + keylen, datalen)
 
@@ -568,6 +574,283 @@ class OrderedHashReader(HashReader):
         return _get_pos(indexbase + lo * indexsize)
 
 
+# Front-coded ordered file
+
+class FrontCodedWriter(object):
+    """Writes an ordered key-value file where the keys are front-coded: keys
+    are stored in blocks of ``blocksize`` entries, and every key after the
+    first in a block only stores the length of the prefix it shares with the
+    previous key and the remaining suffix. Sorted keys such as the terms of a
+    field share long prefixes, so this is much smaller than
+    :class:`OrderedHashWriter`, which stores every key in full plus hash
+    tables.
+
+    The first key of each block is kept in a small index at the end of the
+    file, so a :class:`FrontCodedReader` can find the block a key is in with a
+    binary search in memory and then decode at most one block.
+
+    Keys must be added in increasing order.
+    """
+
+    def __init__(self, dbfile, magic=b("FCD1"), blocksize=16):
+        """
+        :param dbfile: a :class:`~whoosh.filedb.structfile.StructFile` object
+            to write to.
+        :param magic: the format tag bytes to write at the start of the file.
+        :param blocksize: the number of keys in each block.
+        """
+
+        self.dbfile = dbfile
+        self.blocksize = blocksize
+        # A place for subclasses to put extra metadata
+        self.extras = {}
+
+        dbfile.write(magic)
+
+        # The position and first key of each block
+        self.blockpos = []
+        self.blockkeys = []
+        self.count = 0
+        # Keep track of the last key added
+        self.lastkey = emptybytes
+
+    def add(self, key, value):
+        assert isinstance(key, bytes_type)
+        assert isinstance(value, bytes_type)
+
+        lastkey = self.lastkey
+        if key <= lastkey:
+            raise ValueError("Keys must increase: %r..%r" % (lastkey, key))
+
+        dbfile = self.dbfile
+        if self.count % self.blocksize:
+            # Find the length of the prefix shared with the previous key
+            shared = 0
+            end = min(len(key), len(lastkey))
+            while shared < end and key[shared] == lastkey[shared]:
+                shared += 1
+        else:
+            # Start a new block with the whole key
+            self.blockpos.append(dbfile.tell())
+            self.blockkeys.append(key)
+            shared = 0
+
+        dbfile.write(varint(shared) + varint(len(key) - shared) + key[shared:]
+                     + varint(len(value)))
+        dbfile.write(value)
+        self.count += 1
+        self.lastkey = key
+
+    def add_all(self, items):
+        add = self.add
+        for key, value in items:
+            add(key, value)
+
+    def close(self):
+        dbfile = self.dbfile
+
+        # Write the block index: the number of blocks, the block positions,
+        # the lengths of the first keys, and the first keys themselves
+        indexpos = dbfile.tell()
+        dbfile.write_uint(len(self.blockpos))
+        dbfile.write_array(array("q", self.blockpos))
+        dbfile.write_array(array("I", [len(k) for k in self.blockkeys]))
+        dbfile.write(emptybytes.join(self.blockkeys))
+        # Write extra information
+        self.extras["count"] = self.count
+        dbfile.write_pickle(self.extras)
+        # Write the position of the block index
+        dbfile.write_long(indexpos)
+
+        endpos = dbfile.tell()
+        dbfile.close()
+        return endpos
+
+
+class FrontCodedReader(object):
+    """Reader for the ordered key-value files created by
+    :class:`FrontCodedWriter`.
+    """
+
+    def __init__(self, dbfile, length=None, magic=b("FCD1")):
+        """
+        :param dbfile: a :class:`~whoosh.filedb.structfile.StructFile` object
+            to read from.
+        :param length: the length of the file data. This is necessary since the
+            block index is written at the end of the file.
+        :param magic: the format tag bytes to look for at the start of the
+            file. If the file's format tag does not match these bytes, the
+            object raises a :class:`FileFormatError` exception.
+        """
+
+        self.dbfile = dbfile
+        self.is_closed = False
+
+        if length is None:
+            dbfile.seek(0, os.SEEK_END)
+            length = dbfile.tell()
+
+        dbfile.seek(0)
+        filemagic = dbfile.read(4)
+        if filemagic != magic:
+            raise FileFormatError("Unknown file header %r" % filemagic)
+
+        # Read the block index from the end of the file
+        self.endofdata = dbfile.get_long(length - _LONG_SIZE)
+        dbfile.seek(self.endofdata)
+        blockcount = dbfile.read_uint()
+        # Add the end of the data as a sentinel so the length of any block is
+        # the difference between its position and the next one
+        self.blockpos = list(dbfile.read_array("q", blockcount))
+        self.blockpos.append(self.endofdata)
+        keylens = dbfile.read_array("I", blockcount)
+        keydata = dbfile.read(sum(keylens))
+        self.blockkeys = []
+        pos = 0
+        for keylen in keylens:
+            self.blockkeys.append(keydata[pos:pos + keylen])
+            pos += keylen
+        self.extras = dbfile.read_pickle()
+
+    @classmethod
+    def open(cls, storage, name):
+        length = storage.file_length(name)
+        dbfile = storage.open_file(name)
+        return cls(dbfile, length)
+
+    def file(self):
+        return self.dbfile
+
+    def close(self):
+        if self.is_closed:
+            raise Exception("Tried to close %r twice" % self)
+        self.dbfile.close()
+        self.is_closed = True
+
+    def __len__(self):
+        return self.extras["count"]
+
+    def _block_ranges(self, blocknum):
+        # Yields (key, datapos, datalen) tuples for the keys in a block
+
+        start = self.blockpos[blocknum]
+        bs = self.dbfile.get(start, self.blockpos[blocknum + 1] - start)
+        end = len(bs)
+        key = emptybytes
+        i = 0
+        while i < end:
+            # The lengths are almost always single byte varints
+            shared = bs[i]
+            if shared < 128:
+                i += 1
+            else:
+                shared, i = decode_varint(bs, i)
+            suffixlen = bs[i]
+            if suffixlen < 128:
+                i += 1
+            else:
+                suffixlen, i = decode_varint(bs, i)
+            key = key[:shared] + bs[i:i + suffixlen]
+            i += suffixlen
+            datalen = bs[i]
+            if datalen < 128:
+                i += 1
+            else:
+                datalen, i = decode_varint(bs, i)
+            yield key, start + i, datalen
+            i += datalen
+
+    def _ranges(self, blocknum=0):
+        for blocknum in xrange(blocknum, len(self.blockkeys)):
+            for item in self._block_ranges(blocknum):
+                yield item
+
+    def ranges_from(self, key):
+        """Yields a series of ``(key, datapos, datalen)`` tuples for the
+        ordered series of keys equal to or greater than the given key.
+        """
+
+        # The key can only be in the last block starting at or before it
+        blocknum = max(0, bisect_right(self.blockkeys, key) - 1)
+        ranges = self._ranges(blocknum)
+        for item in ranges:
+            if item[0] >= key:
+                yield item
+                break
+        for item in ranges:
+            yield item
+
+    def range_for_key(self, key):
+        """Returns a ``(datapos, datalen)`` tuple for the given key, or raises
+        ``KeyError`` if the key isn't in the file.
+        """
+
+        blocknum = bisect_right(self.blockkeys, key) - 1
+        if blocknum >= 0:
+            for k, datapos, datalen in self._block_ranges(blocknum):
+                if k == key:
+                    return datapos, datalen
+                elif k > key:
+                    break
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self.range_for_key(key)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, key):
+        datapos, datalen = self.range_for_key(key)
+        return self.dbfile.get(datapos, datalen)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def closest_key(self, key):
+        """Returns the closest key equal to or greater than the given key. If
+        there is no key in the file equal to or greater than the given key,
+        returns None.
+        """
+
+        for k, _, _ in self.ranges_from(key):
+            return k
+        return None
+
+    def __iter__(self):
+        return self.items()
+
+    def keys(self):
+        for key, _, _ in self._ranges():
+            yield key
+
+    def keys_from(self, key):
+        """Yields an ordered series of keys equal to or greater than the given
+        key.
+        """
+
+        for k, _, _ in self.ranges_from(key):
+            yield k
+
+    def items(self):
+        get = self.dbfile.get
+        for key, datapos, datalen in self._ranges():
+            yield key, get(datapos, datalen)
+
+    def items_from(self, key):
+        """Yields an ordered series of ``(key, value)`` tuples for keys equal
+        to or greater than the given key.
+        """
+
+        get = self.dbfile.get
+        for k, datapos, datalen in self.ranges_from(key):
+            yield k, get(datapos, datalen)
+
+
 # Fielded Ordered hash file
 
 class FieldedOrderedHashWriter(HashWriter):
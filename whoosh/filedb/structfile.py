@@ -29,12 +29,12 @@ from array import array
 from copy import copy
 from struct import calcsize
 
-from WhooshSearch.whoosh.compat import BytesIO, bytes_type
+from WhooshSearch.whoosh.compat import bytes_type
 from WhooshSearch.whoosh.compat import dump as dump_pickle
 from WhooshSearch.whoosh.compat import load as load_pickle
 from WhooshSearch.whoosh.compat import array_frombytes, array_tobytes
 from WhooshSearch.whoosh.system import _INT_SIZE, _SHORT_SIZE, _FLOAT_SIZE, _LONG_SIZE
-from WhooshSearch.whoosh.system import IS_LITTLE
+from WhooshSearch.whoosh.system import IS_LITTLE, emptybytes
 from WhooshSearch.whoosh.system import pack_byte, unpack_byte, pack_sbyte, unpack_sbyte
 from WhooshSearch.whoosh.system import pack_ushort, unpack_ushort
 from WhooshSearch.whoosh.system import pack_ushort_le, unpack_ushort_le
@@ -321,40 +321,120 @@ class StructFile(object):
         self.seek(position)
         return self.read(length)
 
+    def get_view(self, position, length):
+        """Returns the given range of the file as a buffer object. Files
+        backed by memory (see :class:`BufferFile`) return a view of the
+        underlying buffer without copying; this implementation just returns
+        the bytes from :meth:`StructFile.get`.
+
+        Use this when the data is only going to be unpacked, compared, or
+        decompressed, and won't be kept around.
+        """
+
+        return self.get(position, length)
+
     def get_byte(self, position):
-        return unpack_byte(self.get(position, 1))[0]
+        return unpack_byte(self.get_view(position, 1))[0]
 
     def get_sbyte(self, position):
-        return unpack_sbyte(self.get(position, 1))[0]
+        return unpack_sbyte(self.get_view(position, 1))[0]
 
     def get_int(self, position):
-        return unpack_int(self.get(position, _INT_SIZE))[0]
+        return unpack_int(self.get_view(position, _INT_SIZE))[0]
 
     def get_uint(self, position):
-        return unpack_uint(self.get(position, _INT_SIZE))[0]
+        return unpack_uint(self.get_view(position, _INT_SIZE))[0]
 
     def get_ushort(self, position):
-        return unpack_ushort(self.get(position, _SHORT_SIZE))[0]
+        return unpack_ushort(self.get_view(position, _SHORT_SIZE))[0]
 
     def get_long(self, position):
-        return unpack_long(self.get(position, _LONG_SIZE))[0]
+        return unpack_long(self.get_view(position, _LONG_SIZE))[0]
 
     def get_ulong(self, position):
-        return unpack_ulong(self.get(position, _LONG_SIZE))[0]
+        return unpack_ulong(self.get_view(position, _LONG_SIZE))[0]
 
     def get_float(self, position):
-        return unpack_float(self.get(position, _FLOAT_SIZE))[0]
+        return unpack_float(self.get_view(position, _FLOAT_SIZE))[0]
 
     def get_array(self, position, typecode, length):
         self.seek(position)
         return self.read_array(typecode, length)
 
 
+class BufferReader(object):
+    """A minimal read-only file object over a buffer, such as a memoryview of
+    a memory map. Unlike ``BytesIO(buf)`` this doesn't copy the buffer, so
+    opening a file inside a memory-mapped compound file doesn't pull the
+    whole sub-file into memory.
+    """
+
+    def __init__(self, buf):
+        self._buf = buf
+        self._len = len(buf)
+        self._pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+    def read(self, size=-1):
+        pos = self._pos
+        end = self._len
+        if size is not None and size >= 0:
+            end = min(pos + size, end)
+        if end <= pos:
+            return emptybytes
+        self._pos = end
+        return bytes_type(self._buf[pos:end])
+
+    def readline(self, size=-1):
+        buf = self._buf
+        pos = self._pos
+        end = self._len
+        if size is not None and size >= 0:
+            end = min(pos + size, end)
+
+        # Look for the newline a chunk at a time to avoid copying the rest of
+        # the buffer
+        i = pos
+        while i < end:
+            chunk = bytes_type(buf[i:min(i + 256, end)])
+            n = chunk.find(b"\n")
+            if n >= 0:
+                end = i + n + 1
+                break
+            i += len(chunk)
+        return self.read(end - pos)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._len
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._buf = None
+
+
 class BufferFile(StructFile):
     def __init__(self, buf, name=None, onclose=None):
         self._buf = buf
         self._name = name
-        self.file = BytesIO(buf)
+        self.file = BufferReader(buf)
         self.onclose = onclose
 
         self.is_real = False
@@ -362,14 +442,25 @@ class BufferFile(StructFile):
 
     def subset(self, position, length, name=None):
         name = name or self._name
-        return BufferFile(self.get(position, length), name=name)
+        return BufferFile(self.get_view(position, length), name=name)
 
     def get(self, position, length):
         return bytes_type(self._buf[position:position + length])
 
+    def get_view(self, position, length):
+        return self._buf[position:position + length]
+
+    def read_array(self, typecode, length):
+        pos = self.file.tell()
+        size = length * _SIZEMAP[typecode]
+        a = self.get_array(pos, typecode, length)
+        self.file.seek(pos + size)
+        return a
+
     def get_array(self, position, typecode, length):
         a = array(typecode)
-        array_frombytes(a, self.get(position, length * _SIZEMAP[typecode]))
+        array_frombytes(a, self.get_view(position,
+                                         length * _SIZEMAP[typecode]))
         if IS_LITTLE:
             a.byteswap()
         return a
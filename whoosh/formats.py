@@ -32,6 +32,8 @@ occurance of a term.
 """
 
 from collections import defaultdict
+from itertools import accumulate
+from operator import itemgetter
 
 from WhooshSearch.whoosh.analysis import unstopped, entoken
 from WhooshSearch.whoosh.compat import iteritems, dumps, loads, b
@@ -240,12 +242,7 @@ class Positions(Format):
         if not valuestring.endswith(b(".")):
             valuestring += b(".")
         codes = loads(valuestring[_INT_SIZE:])
-        position = 0
-        positions = []
-        for code in codes:
-            position += code
-            positions.append(position)
-        return positions
+        return list(accumulate(codes))
 
     def decode_frequency(self, valuestring):
         return unpack_uint(valuestring[:_INT_SIZE])[0]
@@ -316,12 +313,7 @@ class Characters(Positions):
         if not valuestring.endswith(b(".")):
             valuestring += b(".")
         codes = loads(valuestring[_INT_SIZE:])
-        position = 0
-        posns = []
-        for code in codes:
-            position = code[0] + position
-            posns.append(position)
-        return posns
+        return list(accumulate(map(itemgetter(0), codes)))
 
     def combine(self, vs):
         s = {}
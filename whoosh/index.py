@@ -369,6 +369,13 @@ class Index(object):
 
 # Codec-based index implementation
 
+# IDs of segments that are being written by a background merge in this
+# process (see whoosh.writing.BackgroundMerger). They aren't listed in any TOC
+# until the merge swaps them in, so clean_files() has to leave their files
+# alone. Merges in other processes aren't visible here.
+_pending_segments = set()
+
+
 def clean_files(storage, indexname, gen, segments):
     # Attempts to remove unused index files (called when a new generation
     # is created). If existing Index and/or reader objects have the files
@@ -380,6 +387,7 @@ def clean_files(storage, indexname, gen, segments):
     segpattern = TOC._segment_pattern(indexname)
 
     todelete = set()
+    removed_segment_names = set()
     for filename in storage:
         if filename.startswith("."):
             continue
@@ -390,8 +398,10 @@ def clean_files(storage, indexname, gen, segments):
                 todelete.add(filename)
         elif segm:
             name = segm.group(1)
-            if name not in current_segment_names:
+            if (name not in current_segment_names
+                    and name not in _pending_segments):
                 todelete.add(filename)
+                removed_segment_names.add(name)
 
     for filename in todelete:
         try:
@@ -400,6 +410,13 @@ def clean_files(storage, indexname, gen, segments):
             # Another process still has this file open, I guess
             pass
 
+    if removed_segment_names:
+        # Drop the removed segments' decoded posting blocks from the shared
+        # block cache
+        from WhooshSearch.whoosh.codec.whoosh3 import block_cache
+
+        block_cache.remove_if(lambda key: key[0] in removed_segment_names)
+
 
 class FileIndex(Index):
     def __init__(self, storage, schema=None, indexname=_DEF_INDEX_NAME):
@@ -506,18 +523,23 @@ class FileIndex(Index):
 
             if reuse:
                 # Put all atomic readers in a dictionary keyed by their
-                # generation, so we can re-use them if them if possible
-                readers = [r for r, _ in reuse.leaf_readers()]
-                reusable = dict((r.generation(), r) for r in readers)
+                # segment ID, so we can re-use them if them if possible
+                readers = [r for r, _ in reuse.leaf_readers()
+                           if isinstance(r, SegmentReader)]
+                reusable = dict((r.segment().segment_id(), r) for r in readers)
 
             # Make a function to open readers, which reuses reusable readers.
             # It removes any readers it reuses from the "reusable" dictionary,
             # so later we can close any readers left in the dictionary.
             def segreader(segment):
                 segid = segment.segment_id()
-                if segid in reusable:
-                    r = reusable[segid]
+                r = reusable.get(segid)
+                # Deletions only grow, so an equal deleted count means the
+                # reader still has the segment's current set of deletions
+                if (r is not None
+                    and r.segment().deleted_count() == segment.deleted_count()):
                     del reusable[segid]
+                    r._gen = generation
                     return r
                 else:
                     return SegmentReader(storage, schema, segment,
@@ -25,6 +25,8 @@
 # those of the authors and should not be interpreted as representing official
 # policies, either expressed or implied, of Matt Chaput.
 
+from heapq import merge
+
 from WhooshSearch.whoosh.matching import mcore
 
 
@@ -191,6 +193,15 @@ class UnionMatcher(AdditiveBiMatcher):
     #def all_ids(self):
     #    return iter(sorted(set(self.a.all_ids()) | set(self.b.all_ids())))
 
+    def all_ids(self):
+        # Merge the sorted ids of the sub-matchers without decoding their
+        # weights and values, in constant memory
+        last = None
+        for id in merge(self.a.all_ids(), self.b.all_ids()):
+            if id != last:
+                yield id
+                last = id
+
     def next(self):
         self._id = None
 
@@ -588,7 +599,7 @@ class AndNotMatcher(BiMatcher):
     def _find_next(self):
         pos = self.a
         neg = self.b
-        if not neg.is_active():
+        if not (pos.is_active() and neg.is_active()):
             return
         pos_id = pos.id()
         r = False
@@ -682,6 +693,22 @@ class AndNotMatcher(BiMatcher):
     def value_as(self, astype):
         return self.a.value_as(astype)
 
+    def all_ids(self):
+        if not self.b.is_active():
+            for id in self.a.all_ids():
+                yield id
+            return
+
+        # Step through the sorted excluded ids alongside instead of keeping a
+        # set of them
+        excluded = self.b.all_ids()
+        ex = next(excluded, None)
+        for id in self.a.all_ids():
+            while ex is not None and ex < id:
+                ex = next(excluded, None)
+            if id != ex:
+                yield id
+
 
 class AndMaybeMatcher(AdditiveBiMatcher):
     """Matches postings in the first sub-matcher, and if the same posting is
@@ -310,3 +310,175 @@ class ArrayUnionMatcher(CombinationMatcher):
 
     def score(self):
         return self._a[self._docnum - self._offset]
+
+
+class BlockMaxUnionMatcher(CombinationMatcher):
+    """Matches the union (OR) of the postings in the sub-matchers, using the
+    block-max WAND algorithm to skip documents that can't make the top N.
+
+    Once a minimum quality is set through ``replace()``, the sub-matchers are
+    kept sorted by their current ID and only moved to a document if the sum of
+    their ``max_quality()`` can exceed the minimum. Before such a document is
+    returned, the ``block_quality()`` of the sub-matchers on it is checked,
+    and if the current blocks together can't exceed the minimum, the matchers
+    skip to the end of the shortest of those blocks without scoring anything.
+
+    Until a minimum quality is set, this matcher works like a tree of
+    :class:`~whoosh.matching.binary.UnionMatcher` objects. All sub-matchers
+    must support block quality.
+    """
+
+    def __init__(self, submatchers, boost=1.0, minquality=0):
+        CombinationMatcher.__init__(self, submatchers, boost=boost)
+        self._minquality = minquality
+        self._id = None
+        # The sub-matchers positioned on the current document
+        self._current = []
+        self._find_next(minquality)
+
+    def __repr__(self):
+        return "%s(%r, boost=%f, minquality=%f)" % (self.__class__.__name__,
+                                                   self._submatchers,
+                                                   self._boost,
+                                                   self._minquality)
+
+    def _find_next(self, minquality):
+        # Moves the sub-matchers forward from their current positions to the
+        # first document which might score above minquality and returns the
+        # number of skips it took
+
+        boost = self._boost
+        skipped = 0
+        while True:
+            subs = [m for m in self._submatchers if m.is_active()]
+            self._submatchers = subs
+            if not subs:
+                self._id = None
+                self._current = []
+                return skipped
+            if not minquality:
+                _id = min(m.id() for m in subs)
+                self._id = _id
+                self._current = [m for m in subs if m.id() == _id]
+                return skipped
+
+            # Find the pivot: the first matcher in ID order where the sum of
+            # the max qualities of it and the matchers before it can exceed
+            # the minimum
+            subs.sort(key=lambda m: m.id())
+            total = 0
+            for pivot, m in enumerate(subs):
+                total += m.max_quality() * boost
+                if total > minquality:
+                    break
+            else:
+                # Even all the matchers together can't exceed the minimum
+                self._submatchers = []
+                self._id = None
+                self._current = []
+                return skipped
+            pivotid = subs[pivot].id()
+
+            if subs[0].id() < pivotid:
+                # The documents before the pivot can't make it, so move the
+                # matchers before the pivot up to it
+                for m in subs[:pivot]:
+                    if m.id() < pivotid:
+                        m.skip_to(pivotid)
+                skipped += 1
+                continue
+
+            # All matchers up to the pivot are on the pivot document, check
+            # the quality of their current blocks
+            onpivot = [m for m in subs if m.id() == pivotid]
+            blockq = sum(m.block_quality() for m in onpivot) * boost
+            if blockq > minquality:
+                self._id = pivotid
+                self._current = onpivot
+                return skipped
+
+            # None of the documents up to the end of the shortest current block
+            # can make it, unless another matcher joins in before that
+            target = min(m.block_max_id() for m in onpivot) + 1
+            if len(onpivot) < len(subs):
+                target = min(target, subs[len(onpivot)].id())
+            for m in onpivot:
+                m.skip_to(target)
+            skipped += 1
+
+    def copy(self):
+        return self.__class__([m.copy() for m in self._submatchers],
+                              boost=self._boost, minquality=self._minquality)
+
+    def depth(self):
+        return 1 + max([0] + [m.depth() for m in self._submatchers])
+
+    def reset(self):
+        for m in self._submatchers:
+            m.reset()
+        self._find_next(self._minquality)
+
+    def replace(self, minquality=0):
+        subs = [m for m in self._submatchers if m.is_active()]
+        if not subs:
+            return mcore.NullMatcher()
+        elif len(subs) == 1 and self._boost == 1.0:
+            return subs[0].replace(minquality)
+
+        # Only raise the minimum for the documents after this one. Moving to a
+        # new document here would leave a parent matcher that gets this same
+        # object back out of step with it
+        self._minquality = max(minquality, self._minquality)
+        return self
+
+    def is_active(self):
+        return self._id is not None
+
+    def id(self):
+        return self._id
+
+    def next(self):
+        if not self.is_active():
+            raise mcore.ReadTooFar
+
+        for m in self._current:
+            m.next()
+        self._find_next(self._minquality)
+        return False
+
+    def skip_to(self, id):
+        if not self.is_active():
+            raise mcore.ReadTooFar
+        if id <= self._id:
+            return
+
+        for m in self._submatchers:
+            if m.is_active() and m.id() < id:
+                m.skip_to(id)
+        self._find_next(self._minquality)
+
+    def skip_to_quality(self, minquality):
+        if not self.is_active():
+            raise mcore.ReadTooFar
+
+        # Unlike replace(), the minimum is only used for this call
+        return self._find_next(max(minquality, self._minquality))
+
+    def max_quality(self):
+        return sum(m.max_quality() for m in self._submatchers
+                   if m.is_active()) * self._boost
+
+    def block_quality(self):
+        return sum(m.block_quality() for m in self._current) * self._boost
+
+    def block_max_id(self):
+        return min(m.block_max_id() for m in self._current)
+
+    def weight(self):
+        return sum(m.weight() for m in self._current) * self._boost
+
+    def score(self):
+        return sum(m.score() for m in self._current) * self._boost
+
+    def spans(self):
+        return sorted(set(span for m in self._current for span in m.spans()))
@@ -192,6 +192,14 @@ class Matcher(object):
 
         raise NoQualityAvailable(self.__class__)
 
+    def block_max_id(self):
+        """Returns the last ID in the current block of postings, that is the
+        last ID ``block_quality()`` applies to. Matchers that don't know about
+        blocks return the current ID.
+        """
+
+        return self.id()
+
     @abstractmethod
     def id(self):
         """Returns the ID of the current posting.
@@ -218,6 +226,18 @@ class Matcher(object):
                 m = m.replace()
                 i = 0
 
+    def id_count(self):
+        """Returns the number of IDs in the matcher. Like
+        :meth:`Matcher.all_ids`, this doesn't need scores, weights or values,
+        so subclasses can override it to only read what they need to count
+        the postings.
+
+        As with :meth:`Matcher.all_ids`, it's best to only use this method on
+        fresh matchers.
+        """
+
+        return sum(1 for _ in self.all_ids())
+
     def all_items(self):
         """Returns a generator of all (ID, encoded value) pairs in the matcher.
 
@@ -548,6 +568,10 @@ class ListMatcher(Matcher):
         else:
             return 1.0
 
+    def block_max_id(self):
+        # The whole list is one "block"
+        return self._ids[-1]
+
     def block_min_length(self):
         return self._terminfo.min_length()
 
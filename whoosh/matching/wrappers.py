@@ -109,6 +109,9 @@ class WrappingMatcher(mcore.Matcher):
     def block_quality(self):
         return self.child.block_quality() * self.boost
 
+    def block_max_id(self):
+        return self.child.block_max_id()
+
     def weight(self):
         return self.child.weight() * self.boost
 
@@ -194,6 +197,9 @@ class MultiMatcher(mcore.Matcher):
             for id in mr.all_ids():
                 yield id + offsets[i]
 
+    def id_count(self):
+        return sum(mr.id_count() for mr in self.matchers[self.current:])
+
     def spans(self):
         return self.matchers[self.current].spans()
 
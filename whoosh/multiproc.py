@@ -31,7 +31,7 @@ from multiprocessing import Process, Queue, cpu_count
 
 from WhooshSearch.whoosh.compat import queue, xrange, iteritems, pickle
 from WhooshSearch.whoosh.codec import base
-from WhooshSearch.whoosh.writing import PostingPool, SegmentWriter
+from WhooshSearch.whoosh.writing import PostingPool, SegmentWriter, IndexingError
 from WhooshSearch.whoosh.externalsort import imerge
 from WhooshSearch.whoosh.util import random_name
 
@@ -63,7 +63,7 @@ class SubWriterTask(Process):
     # them, and when it's done, puts a summary of its work on a results Queue
 
     def __init__(self, storage, indexname, jobqueue, resultqueue, kwargs,
-                 multisegment):
+                 multisegment, loader=None):
         Process.__init__(self)
         self.storage = storage
         self.indexname = indexname
@@ -71,6 +71,7 @@ class SubWriterTask(Process):
         self.resultqueue = resultqueue
         self.kwargs = kwargs
         self.multisegment = multisegment
+        self.loader = loader
         self.running = True
 
     def run(self):
@@ -100,6 +101,9 @@ class SubWriterTask(Process):
 
         # If the parent task calls cancel() on me, it will set self.running to
         # False, so I'll notice the next time through the loop
+        # An exception (e.g. from the loader) ends the process with exit code
+        # 1. The parent checks for it, cancels itself and removes the temp
+        # files of all the tasks
         while self.running:
             # Take an object off the job queue
             jobinfo = jobqueue.get()
@@ -134,10 +138,11 @@ class SubWriterTask(Process):
 
     def _process_file(self, filename, doc_count):
         # This method processes a "job file" written out by the parent task. A
-        # job file is a series of pickled (code, arguments) tuples. Currently
-        # the only command codes is 0=add_document
+        # job file is a series of pickled (code, arguments) tuples. The
+        # command codes are 0=add_document and 1=load_document
 
         writer = self.writer
+        loader = self.loader
         tempstorage = writer.temp_storage()
 
         load = pickle.load
@@ -145,7 +150,15 @@ class SubWriterTask(Process):
             for _ in xrange(doc_count):
                 # Load the next pickled tuple from the file
                 code, args = load(f)
-                assert code == 0
+                if code == 1:
+                    # The arguments only describe the document, call the
+                    # loader to produce the actual fields (the loader can
+                    # return None to skip the document)
+                    args = loader(**args)
+                    if args is None:
+                        continue
+                else:
+                    assert code == 0
                 writer.add_document(**args)
         # Remove the job file
         tempstorage.delete_file(filename)
@@ -156,7 +169,7 @@ class SubWriterTask(Process):
 
 class MpWriter(SegmentWriter):
     def __init__(self, ix, procs=None, batchsize=100, subargs=None,
-                 multisegment=False, **kwargs):
+                 multisegment=False, loader=None, **kwargs):
         # This is the "main" writer that will aggregate the results created by
         # the sub-tasks
         SegmentWriter.__init__(self, ix, **kwargs)
@@ -171,6 +184,9 @@ class MpWriter(SegmentWriter):
         # If multisegment is True, don't merge the segments created by the
         # sub-writers, just add them directly to the TOC
         self.multisegment = multisegment
+        # A picklable function called by the sub-tasks to turn the arguments
+        # passed to load_document() into a dictionary of fields
+        self.loader = loader
 
         # A list to hold the sub-task Process objects
         self.tasks = []
@@ -187,7 +203,7 @@ class MpWriter(SegmentWriter):
     def _new_task(self):
         task = SubWriterTask(self.storage, self.indexname,
                              self.jobqueue, self.resultqueue, self.subargs,
-                             self.multisegment)
+                             self.multisegment, self.loader)
         self.tasks.append(task)
         task.start()
         return task
@@ -207,13 +223,40 @@ class MpWriter(SegmentWriter):
         if len(self.tasks) < self.procs:
             self._new_task()
         jobinfo = (filename, length)
-        self.jobqueue.put(jobinfo)
+        self._put_job(jobinfo)
         self.docbuffer = []
 
+    def _put_job(self, jobinfo):
+        # The job queue is bounded, so don't block on it forever if the
+        # sub-tasks that would empty it have failed
+        while True:
+            try:
+                self.jobqueue.put(jobinfo, timeout=1)
+                return
+            except queue.Full:
+                self._check_tasks()
+
+    def _check_tasks(self):
+        # A sub-task only exits on its own after it gets None from the job
+        # queue, with exit code 0. Any other exit code means it failed, so
+        # its documents are lost and the writer is cancelled
+        for task in self.tasks:
+            if task.exitcode:
+                self.cancel()
+                raise IndexingError("Indexing sub-process exited with code %s"
+                                    % task.exitcode)
+
     def cancel(self):
+        if self.is_closed:
+            # Already cancelled after a sub-task failed
+            return
         try:
             for task in self.tasks:
                 task.cancel()
+                # cancel() only sets a flag on this process's copy of the task
+                # object, so stop the sub-process itself
+                task.terminate()
+                task.join()
         finally:
             SegmentWriter.cancel(self)
 
@@ -233,6 +276,20 @@ class MpWriter(SegmentWriter):
             self._enqueue()
         self._added_sub = True
 
+    def load_document(self, **args):
+        """Queues a document whose fields are produced in a sub-task by
+        calling ``loader(**args)``. This lets expensive work such as reading
+        the document's content from disk happen in parallel. If the loader
+        returns None the document is skipped.
+        """
+
+        if self.loader is None:
+            raise Exception("This writer was created without a loader")
+        self.docbuffer.append((1, args))
+        if not self._grouping and len(self.docbuffer) >= self.batchsize:
+            self._enqueue()
+        self._added_sub = True
+
     def _read_and_renumber_run(self, path, offset):
         # Note that SortingPool._read_run() automatically deletes the run file
         # when it's finished
@@ -262,7 +319,7 @@ class MpWriter(SegmentWriter):
             self._enqueue()
         # Tell the tasks to finish
         for task in self.tasks:
-            self.jobqueue.put(None)
+            self._put_job(None)
 
         # Merge existing segments
         finalsegments = self._merge_segments(mergetype, optimize, merge)
@@ -270,6 +327,7 @@ class MpWriter(SegmentWriter):
         # Wait for the subtasks to finish
         for task in self.tasks:
             task.join()
+        self._check_tasks()
 
         # Pull a (run_file_name, fieldnames, segment) tuple off the result
         # queue for each sub-task, representing the final results of the task
@@ -312,7 +370,7 @@ class MpWriter(SegmentWriter):
         # If information was added to this writer the conventional (e.g.
         # through add_reader or merging segments), add it as an extra source
         if self._added:
-            sources.append(self.pool.iter_postings())
+            sources.append(self.iter_postings())
 
         pdrs = []
         for runname, fieldnames, segment in results:
@@ -343,12 +401,14 @@ class MpWriter(SegmentWriter):
 class SerialMpWriter(MpWriter):
     # A non-parallel version of the MpWriter for testing purposes
 
-    def __init__(self, ix, procs=None, batchsize=100, subargs=None, **kwargs):
+    def __init__(self, ix, procs=None, batchsize=100, subargs=None,
+                 loader=None, **kwargs):
         SegmentWriter.__init__(self, ix, **kwargs)
 
         self.procs = procs or cpu_count()
         self.batchsize = batchsize
         self.subargs = subargs if subargs else kwargs
+        self.loader = loader
         self.tasks = [SegmentWriter(ix, _lk=False, **self.subargs)
                       for _ in xrange(self.procs)]
         self.pointer = 0
@@ -359,6 +419,11 @@ class SerialMpWriter(MpWriter):
         self.pointer = (self.pointer + 1) % len(self.tasks)
         self._added_sub = True
 
+    def load_document(self, **args):
+        fields = self.loader(**args)
+        if fields is not None:
+            self.add_document(**fields)
+
     def _commit(self, mergetype, optimize, merge):
         # Pull a (run_file_name, segment) tuple off the result queue for each
         # sub-task, representing the final results of the task
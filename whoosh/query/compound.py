@@ -290,6 +290,7 @@ class Or(CompoundQuery):
     DEFAULT_MATCHER = 1  # Use a binary tree of UnionMatchers
     SPLIT_MATCHER = 2  # Use a different strategy for short and long queries
     ARRAY_MATCHER = 3  # Use a matcher that pre-loads docnums and scores
+    BLOCKMAX_MATCHER = 4  # Use a block-max WAND matcher for top N searches
     matcher_type = AUTO_MATCHER
 
     def __init__(self, subqueries, boost=1.0, minmatch=0, scale=None):
@@ -339,7 +340,18 @@ class Or(CompoundQuery):
 
         if matcher_type == self.AUTO_MATCHER:
             dc = searcher.doc_count_all()
-            if (len(subs) < self.TOO_MANY_CLAUSES
+            if (context and context.limit and weighting
+                and context.top_query is self
+                and not weighting.use_final
+                and not self.scale
+                and 2 < len(subs) < self.TOO_MANY_CLAUSES):
+                # If only the top N documents are needed, skip the documents
+                # and blocks that can't make it. Only do this when the
+                # collector drives this matcher directly, since a parent
+                # matcher that doesn't support block quality would make the
+                # collector count the skipped documents as if they were read
+                matcher_type = self.BLOCKMAX_MATCHER
+            elif (len(subs) < self.TOO_MANY_CLAUSES
                 and (needs_current
                      or self.scale
                      or len(subs) == 2
@@ -362,6 +374,9 @@ class Or(CompoundQuery):
         elif matcher_type == self.ARRAY_MATCHER:
             # Implementation that pre-loads docnums and scores into an array
             cls = PreloadedOr
+        elif matcher_type == self.BLOCKMAX_MATCHER:
+            # Implementation that skips documents which can't make the top N
+            cls = BlockMaxOr
         else:
             raise ValueError("Unknown matcher_type %r" % self.matcher_type)
 
@@ -452,6 +467,24 @@ class PreloadedOr(Or):
         return am
 
 
+class BlockMaxOr(Or):
+    JOINT = " bOR "
+
+    def _matcher(self, subs, searcher, context):
+        ms = [sub.matcher(searcher, context) for sub in subs]
+        if not all(m.supports_block_quality() for m in ms):
+            # Without block quality there's nothing to skip on
+            m = make_weighted_tree(matching.UnionMatcher,
+                                   [(sub.estimate_size(searcher.reader()), m)
+                                    for sub, m in zip(subs, ms)])
+        else:
+            m = matching.BlockMaxUnionMatcher(ms)
+
+        if self.boost != 1.0:
+            m = matching.WrappingMatcher(m, self.boost)
+        return m
+
+
 class DisjunctionMax(CompoundQuery):
     """Matches all documents that match any of the subqueries, but scores each
     document using the maximum score from the subqueries.
@@ -43,6 +43,8 @@ For example, to find documents containing "whoosh" at most 5 positions before
 
 """
 
+from bisect import bisect_left
+
 from WhooshSearch.whoosh.matching import mcore, wrappers, binary
 from WhooshSearch.whoosh.query import Query, And, AndMaybe, Or, Term
 from WhooshSearch.whoosh.util import make_binary_tree
@@ -178,6 +180,14 @@ def bisect_spans(spans, start):
     return lo
 
 
+def _is_term_matcher(m):
+    # Returns True if the matcher reads the postings of a single term, possibly
+    # with deleted documents filtered out
+    while isinstance(m, wrappers.FilterMatcher):
+        m = m.child
+    return isinstance(m, mcore.LeafMatcher)
+
+
 # Base matchers
 
 class SpanWrappingMatcher(wrappers.WrappingMatcher):
@@ -583,6 +593,11 @@ class SpanNear2(SpanQuery):
             self.slop = slop
             self.ordered = ordered
             self.mindist = mindist
+            # When every sub-matcher is a term, an ordered match can be ruled
+            # out using only the term positions, without decoding character
+            # ranges or building Span objects
+            self._positional = (ordered and mindist > 0 and all(
+                _is_term_matcher(m) and m.supports("positions") for m in ms))
             isect = make_binary_tree(binary.IntersectionMatcher, ms)
             super(SpanNear2.SpanNear2Matcher, self).__init__(isect)
 
@@ -596,7 +611,53 @@ class SpanNear2(SpanQuery):
                 return mcore.NullMatcher()
             return self
 
+        def _positions_match(self):
+            # Returns True if the positions of the terms in the current
+            # document can form an ordered match. This follows the same rules
+            # as _get_spans, but only tracks where each partial match ends
+            slop = self.slop
+            mindist = self.mindist
+            ms = self.ms
+
+            ends = ms[0].value_as("positions")
+            for m in ms[1:]:
+                positions = m.value_as("positions")
+                if slop == mindist:
+                    # Exact distance, for example a plain phrase
+                    endset = set(ends)
+                    nextends = [pos for pos in positions
+                                if pos - slop in endset]
+                else:
+                    # Look for a partial match ending between pos - slop and
+                    # pos - mindist
+                    nextends = []
+                    for pos in positions:
+                        i = bisect_left(ends, pos - slop)
+                        if i < len(ends) and ends[i] <= pos - mindist:
+                            nextends.append(pos)
+                if not nextends:
+                    return False
+                ends = nextends
+            return True
+
+        def all_ids(self):
+            if not self._positional:
+                for docid in SpanWrappingMatcher.all_ids(self):
+                    yield docid
+                return
+
+            # The positions check gives the same answer as building the
+            # spans, so when only the IDs are wanted the spans are skipped
+            child = self.child
+            while child.is_active():
+                if self._positions_match():
+                    yield child.id()
+                child.next()
+
         def _get_spans(self):
+            if self._positional and not self._positions_match():
+                return []
+
             slop = self.slop
             mindist = self.mindist
             ordered = self.ordered
@@ -619,6 +619,10 @@ class SegmentReader(IndexReader):
         self._codec = codec if codec else segment.codec()
         self._terms = self._codec.terms_reader(self._storage, segment)
         self._perdoc = self._codec.per_document_reader(self._storage, segment)
+        # Deleted document numbers used to filter postings, and the deleted
+        # count they were built at
+        self._deleted = None
+        self._deletedcount = 0
 
     def codec(self):
         return self._codec
@@ -768,11 +772,11 @@ class SegmentReader(IndexReader):
     def expand_prefix(self, fieldname, prefix):
         self._test_field(fieldname)
         prefix = self._text_to_bytes(fieldname, prefix)
-        return IndexReader.expand_prefix(self, fieldname, prefix)
+        return self._terms.expand_prefix(fieldname, prefix)
 
     def lexicon(self, fieldname):
         self._test_field(fieldname)
-        return IndexReader.lexicon(self, fieldname)
+        return self._terms.expand_prefix(fieldname, emptybytes)
 
     def __iter__(self):
         if self.is_closed:
@@ -816,11 +820,25 @@ class SegmentReader(IndexReader):
         text = self._text_to_bytes(fieldname, text)
         format_ = self.schema[fieldname].format
         matcher = self._terms.matcher(fieldname, text, format_, scorer=scorer)
-        deleted = frozenset(self._perdoc.deleted_docs())
+        deleted = self._deleted_set()
         if deleted:
             matcher = FilterMatcher(matcher, deleted, exclude=True)
         return matcher
 
+    def _deleted_set(self):
+        # Builds the set of deleted document numbers once instead of for every
+        # term, and only again if more documents are deleted while this reader
+        # is open (a frozenset, because Python-level bitset lookups are much
+        # slower than set lookups for filtering)
+        perdoc = self._perdoc
+        if not perdoc.has_deletions():
+            return None
+        count = self._segment.deleted_count()
+        if self._deleted is None or count != self._deletedcount:
+            self._deleted = frozenset(perdoc.deleted_docs())
+            self._deletedcount = count
+        return self._deleted
+
     def vector(self, docnum, fieldname, format_=None):
         if self.is_closed:
             raise ReaderClosed
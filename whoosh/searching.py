@@ -666,6 +666,27 @@ class Searcher(object):
             for docnum in method(self):
                 yield docnum
 
+    def count(self, q):
+        """Returns the number of documents matching the given
+        :class:`whoosh.query.Query` object.
+
+        This gives the same number as ``len(searcher.search(q, limit=None))``
+        but is much faster, since the matchers only read document numbers:
+        nothing is scored, no weights or values are decoded, and no results
+        are collected. For example, a single term in a segment without
+        deletions is counted from the block headers alone.
+        """
+
+        context = self.boolean_context()
+        total = 0
+        for subsearcher, _ in self.leaf_searchers():
+            try:
+                m = q.matcher(subsearcher, context)
+            except TermNotFound:
+                continue
+            total += m.id_count()
+        return total
+
     def collector(self, limit=10, sortedby=None, reverse=False, groupedby=None,
                   collapse=None, collapse_limit=1, collapse_order=None,
                   optimize=True, filter=None, mask=None, terms=False,
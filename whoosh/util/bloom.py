@@ -0,0 +1,126 @@
+# Copyright 2012 Matt Chaput. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY MATT CHAPUT ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL MATT CHAPUT OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of Matt Chaput.
+
+"""
+This module contains a simple Bloom filter over byte strings, which can tell
+that a key is definitely not in a set without looking it up.
+"""
+
+from zlib import adler32, crc32
+
+from WhooshSearch.whoosh.compat import xrange
+from WhooshSearch.whoosh.system import pack_uint, unpack_uint, _INT_SIZE
+
+
+def key_hashes(key):
+    """Returns the pair of hashes :class:`BloomFilter` derives the bit
+    positions of a key from. Both are stable across processes (unlike
+    ``hash()``) and much cheaper than a cryptographic digest.
+    """
+
+    # The second hash is made odd so the probes of a key never repeat
+    return crc32(key) & 0xffffffff, (adler32(key) & 0xffffffff) | 1
+
+
+class BloomFilter(object):
+    """A Bloom filter built from a known set of byte string keys. Looking up a
+    key that was added always returns True; looking up any other key returns
+    False except for a small fraction of false positives (about 1% with the
+    default 10 bits per key).
+
+    >>> bf = BloomFilter.from_keys([b"alfa", b"bravo"])
+    >>> b"alfa" in bf
+    True
+    >>> b"charlie" in bf
+    False
+    """
+
+    def __init__(self, bits, hashcount):
+        """
+        :param bits: a bytes-like object holding the bit array. Its length in
+            bits is the size of the filter.
+        :param hashcount: the number of bits set for each key.
+        """
+
+        self._bits = bits
+        self._size = len(bits) * 8
+        self._hashcount = hashcount
+
+    @classmethod
+    def from_keys(cls, keys, bitsperkey=10):
+        """Builds a filter holding the given keys.
+
+        :param keys: a sequence (not an iterator) of byte strings.
+        :param bitsperkey: the number of bits in the filter for each key. More
+            bits mean fewer false positives.
+        """
+
+        hashes = [key_hashes(key) for key in keys]
+        return cls.from_hashes([h[0] for h in hashes], [h[1] for h in hashes],
+                               bitsperkey)
+
+    @classmethod
+    def from_hashes(cls, h1s, h2s, bitsperkey=10):
+        """Builds a filter from the :func:`key_hashes` of the keys, so a
+        writer can keep two 32-bit integers per key (for example in a pair of
+        ``array("I")``) instead of the keys themselves.
+
+        :param h1s: a sequence of the first hash of each key.
+        :param h2s: a sequence of the second hash of each key, in the same
+            order.
+        :param bitsperkey: the number of bits in the filter for each key.
+        """
+
+        # The number of hashes that minimizes false positives is about
+        # bitsperkey * ln(2)
+        hashcount = max(1, min(16, int(bitsperkey * 0.69)))
+        size = max(64, len(h1s) * bitsperkey)
+        size += -size % 8
+        bits = bytearray(size // 8)
+        for h1, h2 in zip(h1s, h2s):
+            for i in xrange(hashcount):
+                pos = (h1 + i * h2) % size
+                bits[pos >> 3] |= 1 << (pos & 7)
+        return cls(bytes(bits), hashcount)
+
+    def __contains__(self, key):
+        bits = self._bits
+        size = self._size
+        h1, h2 = key_hashes(key)
+        for i in xrange(self._hashcount):
+            pos = (h1 + i * h2) % size
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def to_bytes(self):
+        return pack_uint(self._hashcount) + bytes(self._bits)
+
+    @classmethod
+    def from_bytes(cls, bs):
+        hashcount = unpack_uint(bs[:_INT_SIZE])[0]
+        return cls(bs[_INT_SIZE:], hashcount)
@@ -28,6 +28,7 @@
 from __future__ import with_statement
 import functools, random
 from array import array
+from collections import OrderedDict
 from heapq import nsmallest
 from operator import itemgetter
 from threading import Lock
@@ -373,3 +374,97 @@ def clockface_lru_cache(maxsize=100):
         return wrapper
     return decorating_function
 
+
+
+class SizedLRUCache(object):
+    """A least-recently-used cache of values that are bounded by their total
+    size in bytes instead of by their number. Unlike the decorators above,
+    this is an object the caller explicitly gets values from and puts values
+    into, along with the (approximate) size of each value, so several objects
+    can share one cache and its budget.
+
+    The hit and miss counters are available as the ``hits`` and ``misses``
+    attributes and in the ``(hits, misses, maxbytes, currbytes)`` tuple
+    returned by :meth:`SizedLRUCache.cache_info`.
+
+    This object is thread-safe.
+    """
+
+    def __init__(self, maxbytes):
+        """
+        :param maxbytes: the maximum total size of the cached values. A value
+            larger than this is never cached. A value of 0 disables the cache.
+        """
+
+        self.maxbytes = maxbytes
+        self.currbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Maps keys to (value, size) tuples, least recently used first
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """Returns the value cached under the given key and marks it as most
+        recently used, or returns ``default`` if the key is not in the cache.
+        """
+
+        with self._lock:
+            try:
+                value = self._data[key][0]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size):
+        """Caches the given value under the given key, evicting the least
+        recently used values until the total size fits in the budget.
+        """
+
+        if size > self.maxbytes:
+            return
+
+        with self._lock:
+            data = self._data
+            old = data.pop(key, None)
+            if old is not None:
+                self.currbytes -= old[1]
+            data[key] = (value, size)
+            self.currbytes += size
+
+            while self.currbytes > self.maxbytes:
+                _, (_, oldsize) = data.popitem(last=False)
+                self.currbytes -= oldsize
+
+    def remove_if(self, predicate):
+        """Removes the values whose keys the given function returns True for.
+        Returns the number of values removed.
+        """
+
+        with self._lock:
+            data = self._data
+            keys = [key for key in data if predicate(key)]
+            for key in keys:
+                self.currbytes -= data.pop(key)[1]
+            return len(keys)
+
+    def cache_info(self):
+        return self.hits, self.misses, self.maxbytes, self.currbytes
+
+    def clear(self):
+        """Clears the cache and the hit and miss counters.
+        """
+
+        with self._lock:
+            self._data.clear()
+            self.currbytes = 0
+            self.hits = self.misses = 0
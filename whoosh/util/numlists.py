@@ -1,11 +1,20 @@
+import struct
 from array import array
+from bisect import bisect_right
+from itertools import accumulate, chain
 
 from WhooshSearch.whoosh.compat import xrange
-from WhooshSearch.whoosh.system import emptybytes
+from WhooshSearch.whoosh.compat import array_tobytes, array_frombytes
+from WhooshSearch.whoosh.system import emptybytes, IS_LITTLE
 from WhooshSearch.whoosh.system import pack_byte, unpack_byte
 from WhooshSearch.whoosh.system import pack_ushort_le, unpack_ushort_le
 from WhooshSearch.whoosh.system import pack_uint_le, unpack_uint_le
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def delta_encode(nums):
     base = 0
@@ -371,3 +380,155 @@ class GInts(NumberEncoding):
 #        for n in self.read_nums(f, (i + 1) - base):
 #            pass
 #        return n
+
+
+# Patched frame of reference ("PForDelta") packing for a block of integers
+# (usually the gaps between sorted IDs). Every number is stored in the low "b"
+# bits of a little-endian bit string, where b is chosen to make the block as
+# small as possible; the numbers that don't fit ("exceptions") have their high
+# bits patched in from a separate list.
+#
+# B   | Bit width b
+# H   | Number of exceptions
+#     | ceil(count * b / 8) bytes of packed low bits
+#     | Exception positions (bytes, or unsigned shorts for > 256 numbers)
+#     | Exception high bits (unsigned ints)
+#
+# Decoding uses NumPy when it's available and pure Python otherwise.
+
+_PFOR_HEADER = struct.Struct("<BH")
+_ALIGNED_TYPECODES = {8: "B", 16: "H", 32: "I"}
+
+
+def _le_array_bytes(arry):
+    if not IS_LITTLE:
+        arry.byteswap()
+    return array_tobytes(arry)
+
+
+def _le_array(typecode, bs):
+    arry = array(typecode)
+    array_frombytes(arry, bs)
+    if not IS_LITTLE:
+        arry.byteswap()
+    return arry
+
+
+def _pfor_postype(count):
+    return "B" if count <= 256 else "H"
+
+
+def pfor_encode(nums):
+    """Packs a sequence of integers in the range [0, 2 ** 32) into a bytes
+    string using patched frame of reference.
+    """
+
+    nums = list(nums)
+    count = len(nums)
+    possize = array(_pfor_postype(count)).itemsize
+
+    # Pick the bit width that gives the smallest output
+    lengths = sorted(n.bit_length() for n in nums)
+    bestsize = None
+    bits = 0
+    for b in xrange(lengths[-1] + 1 if lengths else 1):
+        exceptions = count - bisect_right(lengths, b)
+        size = (count * b + 7) // 8 + exceptions * (possize + 4)
+        if bestsize is None or size < bestsize:
+            bestsize = size
+            bits = b
+
+    mask = (1 << bits) - 1
+    positions = []
+    highs = []
+    packed = 0
+    for i, n in enumerate(nums):
+        if n > mask:
+            positions.append(i)
+            highs.append(n >> bits)
+        packed |= (n & mask) << (i * bits)
+
+    bytecount = (count * bits + 7) // 8
+    return (_PFOR_HEADER.pack(bits, len(positions))
+            + packed.to_bytes(bytecount, "little")
+            + _le_array_bytes(array(_pfor_postype(count), positions))
+            + _le_array_bytes(array("I", highs)))
+
+
+def pfor_length(bs, count, offset=0):
+    """Returns the length of the packed block of ``count`` numbers at the given
+    offset in a bytes-like object. Only the header of the block is read.
+    """
+
+    bits, excount = _PFOR_HEADER.unpack(bs[offset:offset + _PFOR_HEADER.size])
+    possize = array(_pfor_postype(count)).itemsize
+    return (_PFOR_HEADER.size + (count * bits + 7) // 8
+            + excount * (possize + 4))
+
+
+def pfor_decode(bs, count, offset=0, base=None):
+    """Unpacks ``count`` numbers packed by :func:`pfor_encode` from the given
+    offset in a bytes-like object and returns them as an ``array("I")``.
+
+    If ``base`` is not None, the numbers are treated as deltas and the result
+    is their running sum starting at ``base``, that is ``count + 1`` numbers
+    with ``base`` first.
+    """
+
+    bits, excount = _PFOR_HEADER.unpack(bs[offset:offset + _PFOR_HEADER.size])
+    pos = offset + _PFOR_HEADER.size
+    bytecount = (count * bits + 7) // 8
+    lowbytes = bs[pos:pos + bytecount]
+    pos += bytecount
+
+    positions = highs = ()
+    if excount:
+        postype = _pfor_postype(count)
+        possize = array(postype).itemsize
+        positions = _le_array(postype, bs[pos:pos + excount * possize])
+        pos += excount * possize
+        highs = _le_array("I", bs[pos:pos + excount * 4])
+
+    if numpy is not None:
+        return _pfor_decode_numpy(lowbytes, count, bits, positions, highs,
+                                  base)
+
+    if not bits:
+        nums = array("I", bytes(4 * count))
+    elif bits in _ALIGNED_TYPECODES:
+        nums = _le_array(_ALIGNED_TYPECODES[bits], lowbytes)
+        if bits != 32:
+            nums = array("I", nums)
+    else:
+        packed = int.from_bytes(lowbytes, "little")
+        mask = (1 << bits) - 1
+        nums = array("I", ((packed >> (i * bits)) & mask
+                           for i in xrange(count)))
+    for i, high in zip(positions, highs):
+        nums[i] |= high << bits
+
+    if base is not None:
+        nums = array("I", accumulate(chain((base,), nums)))
+    return nums
+
+
+def _pfor_decode_numpy(lowbytes, count, bits, positions, highs, base):
+    if bits:
+        # Unpack the bit string into a (count x bits) matrix of bits and sum
+        # each row with the place values
+        raw = numpy.frombuffer(lowbytes, dtype=numpy.uint8)
+        matrix = numpy.unpackbits(raw, bitorder="little")[:count * bits]
+        places = numpy.left_shift(numpy.uint64(1),
+                                  numpy.arange(bits, dtype=numpy.uint64))
+        nums = matrix.reshape(count, bits).dot(places)
+    else:
+        nums = numpy.zeros(count, dtype=numpy.uint64)
+
+    if len(positions):
+        nums[numpy.asarray(positions)] |= numpy.left_shift(
+            numpy.asarray(highs, dtype=numpy.uint64), numpy.uint64(bits))
+
+    if base is not None:
+        nums = numpy.cumsum(numpy.concatenate((numpy.array([base], numpy.uint64),
+                                               nums)), dtype=numpy.uint64)
+    return array("I", nums.astype(numpy.uint32).tobytes())
@@ -73,6 +73,24 @@ def varint_to_int(vi):
     return i
 
 
+def decode_varint(bs, pos=0):
+    """Decodes the varint starting at the given position in a bytes-like
+    object (Python 3 bytes or memoryview). Returns a tuple of the integer
+    and the position after the varint.
+    """
+
+    b = bs[pos]
+    pos += 1
+    i = b & 0x7F
+    shift = 7
+    while b & 0x80 != 0:
+        b = bs[pos]
+        pos += 1
+        i |= (b & 0x7F) << shift
+        shift += 7
+    return i, pos
+
+
 def signed_varint(i):
     """Zig-zag encodes a signed integer into a varint.
     """
@@ -26,13 +26,15 @@
 # policies, either expressed or implied, of Matt Chaput.
 
 from __future__ import with_statement
-import threading, time
+import struct, sys, threading, time
+from array import array
 from bisect import bisect_right
 from contextlib import contextmanager
 
 from WhooshSearch.whoosh import columns
-from WhooshSearch.whoosh.compat import abstractmethod, bytes_type
-from WhooshSearch.whoosh.externalsort import SortingPool
+from WhooshSearch.whoosh.compat import abstractmethod, bytes_type, xrange
+from WhooshSearch.whoosh.externalsort import BinarySortingPool, imerge
+from WhooshSearch.whoosh.externalsort import _record_header
 from WhooshSearch.whoosh.fields import UnknownFieldError
 from WhooshSearch.whoosh.index import LockError
 from WhooshSearch.whoosh.system import emptybytes
@@ -126,21 +128,145 @@ def CLEAR(writer, segments):
     return []
 
 
+class TieredMergePolicy(object):
+    """A merge policy which sorts the segments into size tiers, each
+    ``segments_per_tier`` times bigger than the one below it, and merges
+    ``segments_per_tier`` segments of a tier into one segment of the next
+    tier. A document is rewritten about once for every tier it climbs, instead
+    of every time a commit merges the small segments, and the number of
+    segments stays logarithmic in the size of the index.
+
+    Segments holding more than half of ``max_merged_docs`` documents are never
+    merged with others, so the size of the biggest merge is bounded. A segment
+    in which at least ``deleted_ratio`` of the documents are deleted is
+    rewritten by itself to drop them, whatever its size.
+
+    Pass an instance as the ``mergetype`` of :meth:`SegmentWriter.commit` to
+    merge inside the commit (one group of segments per commit), or to a
+    :class:`BackgroundMerger` to merge on a separate thread.
+    """
+
+    def __init__(self, segments_per_tier=10, max_merged_docs=500000,
+                 floor_docs=10, deleted_ratio=0.3):
+        """
+        :param segments_per_tier: the number of segments of a tier that are
+            merged together, which is also the size ratio between tiers.
+        :param max_merged_docs: the maximum number of documents in a segment
+            produced by merging.
+        :param floor_docs: segments smaller than this are all in the lowest
+            tier.
+        :param deleted_ratio: the fraction of deleted documents at which a
+            segment is rewritten.
+        """
+
+        self.segments_per_tier = max(2, segments_per_tier)
+        self.max_merged_docs = max_merged_docs
+        self.floor_docs = max(1, floor_docs)
+        self.deleted_ratio = deleted_ratio
+
+    def _tier(self, doccount):
+        tier = 0
+        size = self.floor_docs * self.segments_per_tier
+        while doccount >= size:
+            tier += 1
+            size *= self.segments_per_tier
+        return tier
+
+    def find_merges(self, segments):
+        """Returns a list of the groups of segments that should be merged,
+        each a list of segments, cheapest first.
+        """
+
+        per_tier = self.segments_per_tier
+        tiers = {}
+        rewrites = []
+        for seg in segments:
+            total = seg.doc_count_all()
+            if total and seg.deleted_count() >= total * self.deleted_ratio:
+                rewrites.append([seg])
+            elif seg.doc_count() * 2 <= self.max_merged_docs:
+                tiers.setdefault(self._tier(seg.doc_count()), []).append(seg)
+
+        merges = []
+        for tier in sorted(tiers):
+            segs = sorted(tiers[tier], key=lambda s: s.doc_count())
+            while len(segs) >= per_tier:
+                group, segs = segs[:per_tier], segs[per_tier:]
+                while (len(group) > 1 and sum(s.doc_count() for s in group)
+                       > self.max_merged_docs):
+                    group.pop()
+                if len(group) > 1:
+                    merges.append(group)
+        return merges + rewrites
+
+    def __call__(self, writer, segments):
+        from WhooshSearch.whoosh.reading import SegmentReader
+
+        merges = self.find_merges(segments)
+        if not merges:
+            return segments
+
+        merged = set()
+        for seg in merges[0]:
+            reader = SegmentReader(writer.storage, writer.schema, seg)
+            writer.add_reader(reader)
+            reader.close()
+            merged.add(seg.segment_id())
+        return [seg for seg in segments if seg.segment_id() not in merged]
+
+
 # Customized sorting pool for postings
 
-class PostingPool(SortingPool):
-    # Subclass whoosh.externalsort.SortingPool to use knowledge of
-    # postings to set run size in bytes instead of items
+# The key of a posting in a run is the field name, a NUL byte, the term bytes
+# with NULs escaped as NUL 0xFF, two NUL bytes and the big-endian document
+# number, so comparing keys as bytes orders postings like comparing
+# (fieldname, tbytes, docnum) tuples. The payload is the weight and the value
+# bytes. The document number and the weight are packed together
+_run_docnum = struct.Struct(">I")
+_run_weight = struct.Struct(">d")
+_run_posting = struct.Struct(">Id")
+
+
+def _term_key_prefix(fieldname, tbytes):
+    return (utf8encode(fieldname)[0] + b"\x00"
+            + tbytes.replace(b"\x00", b"\x00\xff") + b"\x00\x00")
+
+
+class PostingPool(BinarySortingPool):
+    # Subclass whoosh.externalsort.BinarySortingPool to use knowledge of
+    # postings to set run size in bytes instead of items.
+    #
+    # Instead of keeping a list of posting tuples and sorting it, the pool
+    # buffers postings as an inverted index: a dictionary mapping each term to
+    # an array of posting numbers, which index parallel arrays of document
+    # numbers and weights and the end offsets of the value bytes in one
+    # bytearray. The terms are only sorted when the buffer is read or saved
+    # to a run, as the binary records of BinarySortingPool with the keys
+    # described above _term_key_prefix(). Merged records are decoded back to
+    # posting tuples.
 
     namechars = "abcdefghijklmnopqrstuvwxyz0123456789"
 
     def __init__(self, tempstore, segment, limitmb=128, **kwargs):
-        SortingPool.__init__(self, **kwargs)
+        BinarySortingPool.__init__(self, **kwargs)
         self.tempstore = tempstore
         self.segment = segment
         self.limit = limitmb * 1024 * 1024
-        self.currentsize = 0
         self.fieldnames = set()
+        self._clear_buffer()
+
+    def _clear_buffer(self):
+        # {fieldname: {tbytes: array of posting numbers}}
+        self._terms = {}
+        self._docnums = array("I")
+        self._weights = array("d")
+        # The values of posting n are _vdata[_vends[n]:_vends[n + 1]]
+        self._vends = array("I", (0,))
+        self._vdata = bytearray()
+        # (fieldname, tbytes) of terms whose postings were not added in
+        # document order
+        self._unordered = set()
+        self.currentsize = 0
 
     def _new_run(self):
         path = "%s.run" % random_name()
@@ -155,29 +281,136 @@ class PostingPool(SortingPool):
 
     def add(self, item):
         # item = (fieldname, tbytes, docnum, weight, vbytes)
-        assert isinstance(item[1], bytes_type), "tbytes=%r" % item[1]
-        if item[4] is not None:
-            assert isinstance(item[4], bytes_type), "vbytes=%r" % item[4]
-        self.fieldnames.add(item[0])
-        size = (28 + 4 * 5  # tuple = 28 + 4 * length
-                + 21 + len(item[0])  # fieldname = str = 21 + length
-                + 26 + len(item[1]) * 2  # text = unicode = 26 + 2 * length
-                + 18  # docnum = long = 18
-                + 16  # weight = float = 16
-                + 21 + len(item[4] or ''))  # valuestring
-        self.currentsize += size
-        if self.currentsize > self.limit:
+        fieldname, tbytes, docnum, weight, vbytes = item
+        assert isinstance(tbytes, bytes_type), "tbytes=%r" % tbytes
+        if vbytes is not None:
+            assert isinstance(vbytes, bytes_type), "vbytes=%r" % vbytes
+
+        try:
+            terms = self._terms[fieldname]
+        except KeyError:
+            terms = self._terms[fieldname] = {}
+            self.fieldnames.add(fieldname)
+
+        docnums = self._docnums
+        postnums = terms.get(tbytes)
+        if postnums is None:
+            terms[tbytes] = array("I", (len(docnums),))
+            # dict entry + bytes key + array
+            self.currentsize += 164 + len(tbytes)
+        else:
+            if docnums[postnums[-1]] > docnum:
+                self._unordered.add((fieldname, tbytes))
+            postnums.append(len(docnums))
+        docnums.append(docnum)
+        self._weights.append(weight)
+        # posting number + docnum + weight + value offset = 20 bytes
+        vdata = self._vdata
+        if vbytes:
+            vdata += vbytes
+            self.currentsize += 20 + len(vbytes)
+        else:
+            self.currentsize += 20
+        self._vends.append(len(vdata))
+
+        # Save a run when the buffer is full, or before the value offsets
+        # could overflow
+        if self.currentsize > self.limit or len(vdata) > 2 ** 31:
             self.save()
-        self.current.append(item)
+
+    def _buffered_items(self):
+        # Yields the buffered postings as (fieldname, tbytes, docnum, weight,
+        # vbytes) tuples sorted by field, term and document number
+        docnums = self._docnums
+        weights = self._weights
+        vends = self._vends
+        vdata = memoryview(self._vdata)
+        unordered = self._unordered
+        try:
+            for fieldname in sorted(self._terms):
+                terms = self._terms[fieldname]
+                for tbytes in sorted(terms):
+                    postnums = terms[tbytes]
+                    if unordered and (fieldname, tbytes) in unordered:
+                        postnums = sorted(postnums, key=docnums.__getitem__)
+                    for n in postnums:
+                        yield (fieldname, tbytes, docnums[n], weights[n],
+                               vdata[vends[n]:vends[n + 1]].tobytes())
+        finally:
+            vdata.release()
+
+    def _write_buffer(self, f, buffersize=1024 * 1024):
+        # Writes the buffered postings to the file as sorted run records
+        docnums = self._docnums
+        weights = self._weights
+        vends = self._vends
+        vdata = memoryview(self._vdata)
+        unordered = self._unordered
+        packheader = _record_header.pack
+        packposting = _run_posting.pack
+        buf = bytearray()
+        try:
+            for fieldname in sorted(self._terms):
+                terms = self._terms[fieldname]
+                for tbytes in sorted(terms):
+                    postnums = terms[tbytes]
+                    if unordered and (fieldname, tbytes) in unordered:
+                        postnums = sorted(postnums, key=docnums.__getitem__)
+                    prefix = _term_key_prefix(fieldname, tbytes)
+                    keylen = len(prefix) + 4
+                    # Check the buffer size every few thousand postings, so
+                    # a very common term doesn't blow it up
+                    for i in xrange(0, len(postnums), 4096):
+                        for n in postnums[i:i + 4096]:
+                            start, end = vends[n], vends[n + 1]
+                            buf += packheader(keylen, 8 + end - start)
+                            buf += prefix
+                            buf += packposting(docnums[n], weights[n])
+                            buf += vdata[start:end]
+                        if len(buf) >= buffersize:
+                            f.write(buf)
+                            buf = bytearray()
+            f.write(buf)
+        finally:
+            vdata.release()
+            f.close()
+
+    def _decode_records(self, records):
+        # Turns (key, payload) run records back into posting tuples, decoding
+        # the field name and term only when they change
+        unpackdoc = _run_docnum.unpack_from
+        unpackweight = _run_weight.unpack_from
+        lastprefix = None
+        for key, payload in records:
+            prefix = key[:-4]
+            if prefix != lastprefix:
+                i = prefix.index(b"\x00")
+                fieldname = prefix[:i].decode("utf8")
+                tbytes = prefix[i + 1:-2].replace(b"\x00\xff", b"\x00")
+                lastprefix = prefix
+            yield (fieldname, tbytes, unpackdoc(key, len(key) - 4)[0],
+                   unpackweight(payload)[0], payload[8:])
+
+    def _read_run(self, path):
+        return self._decode_records(self._read_records(path))
 
     def iter_postings(self):
         # This is just an alias for items() to be consistent with the
         # iter_postings()/add_postings() interface of a lot of other classes
         return self.items()
 
+    def items(self, maxfiles=128):
+        if not self.runs:
+            # Nothing was saved to disk, so read straight from the buffer
+            return self._buffered_items()
+        return self._decode_records(BinarySortingPool.items(self, maxfiles))
+
     def save(self):
-        SortingPool.save(self)
-        self.currentsize = 0
+        if self._docnums:
+            path, f = self._new_run()
+            self._write_buffer(f)
+            self._add_run(path)
+            self._clear_buffer()
 
 
 # Writer base class
@@ -538,6 +771,9 @@ class SegmentWriter(IndexWriter):
         self._added = False
         self.pool = PostingPool(self._tempstorage, self.newsegment,
                                 limitmb=limitmb)
+        # (reader, startdoc, docmap) for each segment being merged into the
+        # new segment, whose postings are merged in when it is flushed
+        self._merging = []
 
         # Set up writers
         self.perdocwriter = codec.per_document_writer(self.storage, newsegment)
@@ -639,7 +875,14 @@ class SegmentWriter(IndexWriter):
                                  self.generation, reuse=reuse)
 
     def iter_postings(self):
-        return self.pool.iter_postings()
+        postings = self.pool.iter_postings()
+        if self._merging:
+            sources = [postings]
+            for reader, startdoc, docmap in self._merging:
+                sources.append(self._process_posts(reader.iter_postings(),
+                                                   startdoc, docmap))
+            postings = imerge(sources)
+        return postings
 
     def add_postings_to_pool(self, reader, startdoc, docmap):
         items = self._process_posts(reader.iter_postings(), startdoc, docmap)
@@ -707,7 +950,19 @@ class SegmentWriter(IndexWriter):
         fieldnames = set(self.schema.names()) | ndxnames
 
         docmap = self.write_per_doc(fieldnames, reader)
-        self.add_postings_to_pool(reader, basedoc, docmap)
+        segment = reader.segment()
+        if segment is not None and segment in self.segments:
+            # The postings of a segment of this index are already sorted, so
+            # instead of adding them to the pool to be sorted again, they're
+            # merged with the pool's postings when the new segment is flushed.
+            # The caller closes its reader, so keep our own open until then
+            from WhooshSearch.whoosh.reading import SegmentReader
+
+            own = SegmentReader(self.storage, self.schema, segment,
+                                codec=reader.codec())
+            self._merging.append((own, basedoc, docmap))
+        else:
+            self.add_postings_to_pool(reader, basedoc, docmap)
         self._added = True
 
     def _check_fields(self, schema, fieldnames):
@@ -833,7 +1088,11 @@ class SegmentWriter(IndexWriter):
         else:
             pdr = None
         postings = self.pool.iter_postings()
-        self.fieldwriter.add_postings(self.schema, pdr, postings)
+        if self._merging:
+            self.fieldwriter.add_merged_postings(self.schema, pdr, postings,
+                                                 self._merging)
+        else:
+            self.fieldwriter.add_postings(self.schema, pdr, postings)
         self.fieldwriter.close()
         if pdr:
             pdr.close()
@@ -843,6 +1102,9 @@ class SegmentWriter(IndexWriter):
             self.perdocwriter.close()
         if not self.fieldwriter.is_closed:
             self.fieldwriter.close()
+        for reader, _, _ in self._merging:
+            reader.close()
+        self._merging = []
         self.pool.cleanup()
 
     def _assemble_segment(self):
@@ -1044,6 +1306,189 @@ class AsyncWriter(threading.Thread, IndexWriter):
             self.writer.cancel(*args, **kwargs)
 
 
+class BackgroundMerger(object):
+    """Runs the merges chosen by a merge policy such as
+    :class:`TieredMergePolicy` on a background thread, so commits can use
+    ``merge=False`` and return without waiting for a merge.
+
+    The merged segment is written without holding the index's write lock. The
+    lock is only taken to swap it into a new TOC, after carrying over any
+    deletions committed to its source segments in the meantime. If a source
+    segment has disappeared by then (for example because the index was
+    cleared), the merge is thrown away.
+
+    >>> merger = BackgroundMerger(myindex)
+    >>> writer = myindex.writer()
+    >>> writer.add_document(...)
+    >>> writer.commit(merge=False)
+    >>> merger.start()
+
+    Only one merger should run on an index at a time, and it only protects
+    its unfinished segment from clean-up by writers in the same process.
+    """
+
+    def __init__(self, index, policy=None, codec=None):
+        """
+        :param index: the :class:`whoosh.index.Index` to merge.
+        :param policy: an object with a ``find_merges(segments)`` method
+            returning groups of segments to merge. The default is a
+            :class:`TieredMergePolicy`.
+        :param codec: the codec used to write merged segments.
+        """
+
+        self.index = index
+        self.policy = policy or TieredMergePolicy()
+        self.codec = codec
+        self.error = None
+        self._thread = None
+        self._again = False
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Starts merging on a background thread. If the thread is already
+        running, it looks for more merges when it runs out of them instead.
+        """
+
+        with self._lock:
+            self._stopped = False
+            if self._thread is not None:
+                self._again = True
+                return
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def running(self):
+        return self._thread is not None
+
+    def wait(self, timeout=None):
+        """Waits for the background thread to run out of merges.
+        """
+
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def stop(self):
+        """Waits for the thread to exit, throwing away the segment of the
+        current merge instead of swapping it in.
+        """
+
+        self._stopped = True
+        self.wait()
+
+    def _run(self):
+        while True:
+            try:
+                while not self._stopped and self.merge_once():
+                    pass
+            except Exception:
+                self.error = sys.exc_info()[1]
+            with self._lock:
+                if self._stopped or not self._again:
+                    self._thread = None
+                    return
+                self._again = False
+
+    def merge_once(self):
+        """Performs the first merge chosen by the policy in the calling
+        thread. Returns False if there was nothing to merge.
+        """
+
+        ix = self.index
+        if not self.policy.find_merges(ix._read_toc().segments):
+            return False
+
+        from WhooshSearch.whoosh.index import _pending_segments
+        from WhooshSearch.whoosh.reading import SegmentReader
+
+        writer = SegmentWriter(ix, _lk=False, codec=self.codec)
+        segid = writer.newsegment.segment_id()
+        _pending_segments.add(segid)
+        try:
+            merges = self.policy.find_merges(writer.segments)
+            if not merges:
+                writer._close_segment()
+                self._delete_segment(writer.newsegment)
+                return False
+
+            group = merges[0]
+            for seg in group:
+                reader = SegmentReader(writer.storage, writer.schema, seg)
+                writer.add_reader(reader)
+                reader.close()
+            # Remember where each source document went, to carry over
+            # deletions committed while the new segment is written
+            docmaps = [(reader.segment(), basedoc, docmap)
+                       for reader, basedoc, docmap in writer._merging]
+            newsegment = writer._finalize_segment()
+            if not self._swap(group, docmaps, newsegment):
+                self._delete_segment(newsegment)
+        except Exception:
+            writer._close_segment()
+            self._delete_segment(writer.newsegment)
+            raise
+        finally:
+            writer.is_closed = True
+            _pending_segments.discard(segid)
+        return True
+
+    def _swap(self, group, docmaps, newsegment):
+        from WhooshSearch.whoosh.index import TOC, clean_files
+
+        ix = self.index
+        lock = ix.lock("WRITELOCK")
+        # A blocking acquire can't be interrupted, so poll for the lock and
+        # give up between tries if stop() was called while a long commit
+        # holds it
+        while not try_for(lock.acquire, timeout=1.0, delay=0.05):
+            if self._stopped:
+                return False
+        try:
+            if self._stopped:
+                return False
+            toc = ix._read_toc()
+            current = dict((seg.segment_id(), seg) for seg in toc.segments)
+            if not all(seg.segment_id() in current for seg in group):
+                return False
+
+            for seg, basedoc, docmap in docmaps:
+                now = current[seg.segment_id()]
+                if now.deleted_count() == seg.deleted_count():
+                    continue
+                for docnum in now.deleted_docs():
+                    if seg.is_deleted(docnum):
+                        continue
+                    if docmap is not None:
+                        newsegment.delete_document(docmap[docnum])
+                    else:
+                        newsegment.delete_document(basedoc + docnum)
+
+            merged = set(seg.segment_id() for seg in group)
+            segments = [seg for seg in toc.segments
+                        if seg.segment_id() not in merged]
+            # If every document of the merge was deleted in the meantime, the
+            # source segments are just dropped
+            if newsegment.doc_count():
+                segments.append(newsegment)
+            generation = toc.generation + 1
+            TOC(toc.schema, segments, generation).write(ix.storage,
+                                                        ix.indexname)
+            clean_files(ix.storage, ix.indexname, generation, segments)
+            return bool(newsegment.doc_count())
+        finally:
+            lock.release()
+
+    def _delete_segment(self, segment):
+        storage = self.index.storage
+        for name in segment.list_files(storage):
+            try:
+                storage.delete_file(name)
+            except OSError:
+                pass
+
+
 # Ex post factor functions
 
 def add_spelling(ix, fieldnames, commit=True):
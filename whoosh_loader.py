@@ -0,0 +1,30 @@
+import io
+import os
+
+
+# Document loading of the indexer. MpWriter sub-processes call file_document
+# by reference, and with the spawn start method (Windows, macOS) they import
+# this module again. So it must not import sublime or the plugin module.
+
+_text_chars = bytearray({7,8,9,10,12,13,27} | set(range(0x20, 0x100)) - {0x7f})
+
+
+def is_binary_file(file_path):
+    with open(file_path, "rb") as f:
+        return bool(f.read(1024).translate(None, _text_chars))
+
+
+def file_content(file_path):
+    with io.open(file_path, encoding="utf-8", errors="ignore") as f:
+        content = f.read()
+    return content
+
+
+# Builds index fields of a project file
+def file_document(path, check_binary=False):
+    if check_binary and is_binary_file(path):
+        return None
+
+    st = os.stat(path)
+    return {"path" : path, "content" : file_content(path),
+            "time" : st.st_mtime, "size" : st.st_size}